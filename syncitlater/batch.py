@@ -0,0 +1,200 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Batch runner, to synchronize many accounts with a single process
+
+The accounts are listed on a JSON manifest file:
+
+    {"accounts": [
+        {"name": "alice", "state": "alice.json"},
+        {"name": "bob", "state_db": "bob.db"}
+    ]}
+
+Each account has its own state (JSON file or SQLite database, with paths
+relative to the manifest) and commit journal. The accounts must be
+authenticated before (e.g. by running simple_tool once using the same
+state file): nothing is asked to the user, and accounts that are not
+authenticated are skipped.
+
+The accounts are synchronized on a pool of worker threads. All of them
+share the same HTTP transport (so connections are reused across accounts)
+and the same global and per-service rate limits.
+"""
+import os, sys
+import json
+import urlparse
+from multiprocessing.pool import ThreadPool
+import pocket, instapaper, statestore, transport
+from dispatch import RateLimiter
+from simple_tool import SimpleSync
+from stats import SyncStats
+
+import logging
+logger = logging.getLogger(__name__)
+info = logger.info
+
+class AccountSync(SimpleSync):
+    """SimpleSync for one account of a batch"""
+    def __init__(self, name, store, journal_path=None, observer=None, transport=None):
+        SimpleSync.__init__(self, store, journal_path, observer, transport)
+        self.name = name
+
+    def check_auth(self, max_age=None):
+        for api in (self.pocketapi, self.instapaperapi):
+            if not api.test_auth(max_age):
+                logger.error('%s: %s authentication failed', self.name, api.__class__.__name__)
+                return False
+        return True
+
+    def show_changes(self, result, verbose=True):
+        info('%s: %s', self.name, ', '.join(['%d changes for %s' % (len(changes), self.engine.member_name(i))
+                                            for i,(member, changes) in enumerate(result)]))
+
+
+def load_manifest(path):
+    """Load the list of accounts from a manifest file
+
+    State paths are made relative to the manifest directory.
+    """
+    manifest = json.load(open(path))
+    basedir = os.path.dirname(os.path.abspath(path))
+    accounts = []
+    for a in manifest['accounts']:
+        a = dict(a)
+        if 'state_db' in a:
+            a['state_db'] = os.path.join(basedir, a['state_db'])
+        else:
+            a['state'] = os.path.join(basedir, a.get('state', a['name'] + '.json'))
+        accounts.append(a)
+    names = [a['name'] for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicate account names on manifest %s' % (path))
+    return accounts
+
+def open_store(account):
+    if 'state_db' in account:
+        return statestore.SqliteStateStore(account['state_db'])
+    return statestore.JsonStateStore(account['state'])
+
+def make_transport(args, observer=None):
+    """Create the HttpTransport shared by all accounts, with the rate limits from args"""
+    limiter = None
+    if args.rate:
+        limiter = RateLimiter(args.rate)
+    host_limiters = {}
+    for base, rate in [(pocket.API_BASE, args.pocket_rate),
+                       (instapaper.API_BASE, args.instapaper_rate)]:
+        if rate:
+            host_limiters[urlparse.urlsplit(base).hostname] = RateLimiter(rate)
+    # keep enough idle connections for all workers
+    return transport.HttpTransport(max_idle=max(8, args.workers), observer=observer,
+                                   limiter=limiter, host_limiters=host_limiters)
+
+def sync_account(account, args, http, observer=None):
+    """Synchronize a single account
+
+    Returns a (name, change count, error message) tuple. Errors are
+    logged and reported on the result instead of being raised, so one
+    account can't stop the whole batch.
+    """
+    name = account['name']
+    store = open_store(account)
+    try:
+        s = AccountSync(name, store, store.path + '.journal', observer, http)
+        if not s.setup(args):
+            return name, None, 'authentication failed'
+        return name, s.run_once(args, verbose=False), None
+    except transport.PleaseReauthenticate:
+        logger.error('%s: credentials rejected by the service', name)
+        return name, None, 'authentication failed'
+    except Exception, e:
+        logger.exception('%s: synchronization failed', name)
+        return name, None, str(e)
+    finally:
+        store.close()
+
+def run_batch(accounts, args, observer=None):
+    """Synchronize all accounts, using args.workers threads
+
+    Returns the list of sync_account() results, in the same order as
+    accounts.
+    """
+    t = make_transport(args, observer)
+    pool = ThreadPool(args.workers)
+    try:
+        results = pool.map(lambda a: sync_account(a, args, t, observer), accounts)
+    finally:
+        pool.close()
+        pool.join()
+        t.close()
+    return results
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Synchronize multiple Instapaper <-> Pocket accounts')
+    parser.add_argument('manifest', metavar='MANIFEST',
+                        help='JSON file with the list of accounts')
+    parser.add_argument('-X', '--commit', dest='dry_run', action='store_false', default=True)
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=True)
+    parser.add_argument('-d', '--debug', dest='debug', action='store_true')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=4,
+                        help='number of accounts synchronized at the same time')
+    parser.add_argument('--rate', dest='rate', type=float, metavar='N',
+                        help='maximum number of API requests per second (all services)')
+    parser.add_argument('--pocket-rate', dest='pocket_rate', type=float, metavar='N',
+                        help='maximum number of Pocket API requests per second')
+    parser.add_argument('--instapaper-rate', dest='instapaper_rate', type=float, metavar='N',
+                        help='maximum number of Instapaper API requests per second')
+    parser.add_argument('--auth-ttl', dest='auth_ttl', type=float, default=86400, metavar='SECONDS',
+                        help="don't test credentials verified less than SECONDS ago (0 to always test)")
+    parser.add_argument('--stats', dest='stats', metavar='FILE',
+                        help='write a JSON report with timings and API usage to FILE')
+    parser.add_argument('-P', '--parallel', dest='parallel', action='store_true',
+                        help='fetch changes from (and commit changes to) all services of each account at the same time')
+    parser.add_argument('--fetch-timeout', dest='fetch_timeout', type=float, metavar='SECONDS',
+                        help='maximum time to fetch changes from each service (with --parallel)')
+    args = parser.parse_args(argv[1:])
+    args.interactive = False
+
+    loglevel = logging.INFO
+    if args.debug:
+        loglevel = logging.DEBUG
+    logging.basicConfig(level=loglevel, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+
+    stats = None
+    if args.stats:
+        stats = SyncStats()
+    results = run_batch(load_manifest(args.manifest), args, stats)
+    if stats:
+        json.dump(stats.report(), open(args.stats, 'w'), indent=1, sort_keys=True)
+
+    failed = 0
+    for name, count, error in results:
+        if error:
+            failed += 1
+            print '%s: FAILED (%s)' % (name, error)
+        else:
+            print '%s: %d changes' % (name, count)
+    print '%d accounts, %d failed' % (len(results), failed)
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
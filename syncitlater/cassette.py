@@ -0,0 +1,179 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Record and replay API traffic
+
+RecordingTransport saves every request/response pair made through
+another transport to a cassette file, and ReplayTransport answers the
+same requests from the cassette, without any network access. The
+cassette is a gzip-compressed file with one JSON object per line.
+
+Requests are matched by method, path and body. OAuth parameters (that
+change on every request) are ignored, and only a hash of each request
+is stored. Responses are stored as they were received, except for the
+authentication requests (paths with an 'oauth' component), which are
+not recorded at all, because their responses contain the access tokens.
+"""
+import gzip
+import json
+import hashlib
+import urllib, urlparse
+import threading
+import StringIO
+from transport import HttpResponse
+
+import logging
+logger = logging.getLogger(__name__)
+info = logger.info
+dbg = logger.debug
+
+
+class CassetteMiss(Exception):
+    """The request being replayed is not on the cassette"""
+    pass
+
+
+def request_key(method, url, body=None, headers=None):
+    """Return the key used to match a request"""
+    u = urlparse.urlsplit(url)
+    ctype = ''
+    for k,v in (headers or {}).items():
+        if k.lower() == 'content-type':
+            ctype = v.lower()
+    body = body or ''
+    if ctype.startswith('application/x-www-form-urlencoded'):
+        args = [(k,v) for k,v in urlparse.parse_qsl(body, keep_blank_values=True) if not k.startswith('oauth_')]
+        body = urllib.urlencode(sorted(args))
+    elif ctype.startswith('application/json') and body:
+        body = json.dumps(json.loads(body), sort_keys=True)
+    h = hashlib.sha1()
+    for part in (method, u.path, u.query, body):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        h.update(part + '\0')
+    return h.hexdigest()
+
+
+def _encode_body(body):
+    try:
+        return dict(body=body.decode('utf-8'))
+    except UnicodeDecodeError:
+        return dict(body_b64=body.encode('base64'))
+
+def _decode_body(entry):
+    if entry.has_key('body_b64'):
+        return entry['body_b64'].decode('base64')
+    return entry['body'].encode('utf-8')
+
+
+class _RecordingStream(object):
+    """Wrapper for a ResponseStream that records the body when it's read until the end"""
+    def __init__(self, stream, record):
+        self._stream = stream
+        self._record = record
+        self._data = []
+
+    def read(self, size=65536):
+        data = self._stream.read(size)
+        if data:
+            self._data.append(data)
+        elif self._record is not None:
+            self._record(''.join(self._data))
+            self._record = None
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+def _is_auth_request(url):
+    """Check if a request is part of the OAuth authentication"""
+    return 'oauth' in urlparse.urlsplit(url).path.split('/')
+
+
+class RecordingTransport(object):
+    """Transport that records the requests made through another transport
+
+    Authentication requests are not recorded.
+    """
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._f = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+
+    def _write(self, key, method, url, r, body):
+        entry = dict(key=key, method=method, path=urlparse.urlsplit(url).path,
+                     status=r.status, reason=r.reason, headers=r.headers)
+        entry.update(_encode_body(body))
+        with self._lock:
+            self._f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def request(self, method, url, body=None, headers=None, stream=False, idempotent=None):
+        key = request_key(method, url, body, headers)
+        r = self.transport.request(method, url, body, headers, stream=stream, idempotent=idempotent)
+        if _is_auth_request(url):
+            dbg('not recording authentication request %s', urlparse.urlsplit(url).path)
+        elif r.stream is None:
+            self._write(key, method, url, r, r.body)
+        else:
+            r.stream = _RecordingStream(r.stream, lambda data: self._write(key, method, url, r, data))
+        return r
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+        self.transport.close()
+
+
+class ReplayTransport(object):
+    """Transport that answers requests using a cassette
+
+    Requests are answered in the same order they were recorded. If a
+    request is made more times than it was recorded, the last response
+    is repeated. Requests that were not recorded raise CassetteMiss.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._responses = {} # key -> list of entries
+        self._used = {}      # key -> number of responses used
+        self._lock = threading.Lock()
+        for line in gzip.open(path, 'rb'):
+            entry = json.loads(line)
+            self._responses.setdefault(entry['key'], []).append(entry)
+        dbg('%d requests loaded from %s', len(self._responses), path)
+
+    def request(self, method, url, body=None, headers=None, stream=False, idempotent=None):
+        key = request_key(method, url, body, headers)
+        with self._lock:
+            entries = self._responses.get(key)
+            if not entries:
+                raise CassetteMiss('%s %s is not on the cassette %s' % (method, urlparse.urlsplit(url).path, self.path))
+            i = self._used.get(key, 0)
+            self._used[key] = i + 1
+            entry = entries[min(i, len(entries) - 1)]
+        data = _decode_body(entry)
+        headers = dict((k,v) for k,v in entry['headers'].items() if k.lower() != 'content-encoding')
+        if stream and entry['status'] < 400:
+            return HttpResponse(url, entry['status'], entry['reason'], headers, None, StringIO.StringIO(data))
+        return HttpResponse(url, entry['status'], entry['reason'], headers, data)
+
+    def close(self):
+        pass
@@ -0,0 +1,178 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Helpers to dispatch API requests concurrently"""
+import sys, time
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import logging
+logger = logging.getLogger(__name__)
+dbg = logger.debug
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter
+
+    Allows up to 'rate' calls per second on average, with bursts of up
+    to 'burst' calls. Can be shared by multiple threads.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call is allowed"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # the token is reserved even if we need to wait for it, so
+            # the threads waiting are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def imap(func, items, workers=1, limiter=None):
+    """Apply func to all items, using a pool of worker threads
+
+    Results are generated in the same order as items, no matter in which
+    order the calls finish. If limiter (a RateLimiter object) is
+    provided, it is used to limit the rate of func calls.
+
+    If workers is 1, no threads are created.
+    """
+    if limiter is not None:
+        def f(i):
+            limiter.acquire()
+            return func(i)
+    else:
+        f = func
+
+    if workers <= 1:
+        for i in items:
+            yield f(i)
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        for r in pool.imap(f, items):
+            yield r
+    except:
+        pool.terminate()
+        raise
+    # not joined: join() waits ~0.1s for the pool's handler threads, and the idle workers exit on their own
+    pool.close()
+
+
+def run_all(func, items, workers=1):
+    """Apply func to all items, using a pool of worker threads
+
+    Returns the list of results. Unlike imap(), all calls run until the
+    end even if some of them fail; the exception raised by the first
+    item that failed is re-raised after all calls finish.
+
+    If workers is 1, no threads are created (and the first exception is
+    raised immediately).
+    """
+    items = list(items)
+    if workers <= 1:
+        return [func(i) for i in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    def run(i):
+        try:
+            results[i] = func(items[i])
+        except:
+            errors[i] = sys.exc_info()
+
+    pool = ThreadPool(min(workers, len(items)) or 1)
+    pool.map(run, range(len(items)))
+    # not joined: join() waits ~0.1s for the pool's handler threads, and the idle workers exit on their own
+    pool.close()
+    for e in errors:
+        if e is not None:
+            raise e[0], e[1], e[2]
+    return results
+
+
+def merge(iterables, maxsize=4):
+    """Iterate over multiple iterables at the same time
+
+    Each iterable is consumed on its own thread, and (index, item) pairs
+    are generated as the items arrive. At most maxsize items are kept
+    waiting for the consumer. Exceptions raised by an iterable are
+    re-raised by the generator.
+
+    If the generator is closed before the end, the threads stop
+    consuming the iterables as soon as they get their next item.
+    """
+    q = Queue.Queue()
+    # room for the items waiting for the consumer
+    room = threading.Semaphore(maxsize)
+    stop = threading.Event()
+    done = object()
+    def put(x):
+        room.acquire()
+        if stop.is_set():
+            return False
+        q.put(x)
+        return True
+
+    def run(i, it):
+        try:
+            for x in it:
+                if not put((i, x, None)):
+                    return
+        except:
+            put((i, done, sys.exc_info()))
+        else:
+            put((i, done, None))
+
+    threads = []
+    for i,it in enumerate(iterables):
+        t = threading.Thread(target=run, args=(i, it))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    remaining = len(threads)
+    try:
+        while remaining:
+            i, x, exc = q.get()
+            room.release()
+            if x is done:
+                remaining -= 1
+                if exc:
+                    raise exc[0], exc[1], exc[2]
+                continue
+            yield i, x
+    finally:
+        stop.set()
+        # wake up the threads waiting for room, so they see the stop event
+        for t in threads:
+            room.release()
@@ -18,10 +18,11 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os
-import urllib2, urllib, urlparse
+import os, time
+import urllib, urlparse
 import json
 import oauth2
+from transport import default_transport, PleaseReauthenticate
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,8 +31,12 @@ dbg = logger.debug
 
 API_BASE = 'https://www.instapaper.com/api/1/'
 
+# API methods that only read data, so they can be sent again after a failure
+READ_METHODS = frozenset(['account/verify_credentials', 'bookmarks/list'])
+
 def api_url(p, *args, **kwargs):
-    u = urlparse.urljoin(API_BASE, p)
+    base = kwargs.pop('api_base', None) or API_BASE
+    u = urlparse.urljoin(base, p)
     if args or kwargs:
         u += '?' + urllib.urlencode(args + kwargs.items())
     return u
@@ -44,33 +49,68 @@ def api_url(p, *args, **kwargs):
 # {u'hash': u'sfhaOra3', u'description': u'Space', u'title': u"Why We Can't Solve Big Problems | MIT Technology Review", u'url': u'http://www.technologyreview.com/featuredstory/429690/why-we-cant-solve-big-problems/', u'progress_timestamp': 0, u'bookmark_id': 334136479, u'time': 1351705881, u'progress': 0, u'starred': u'0', u'type': u'bookmark', u'private_source': u''}
 
 class InstapaperApi:
-    def __init__(self, key, secret, state=None):
+    def __init__(self, key, secret, state=None, transport=None, api_base=None):
         """Constructor
 
         The state object is a dictionary-like object, that will be
         changed by the InstapaperApi in-place.
+
+        transport is the HttpTransport object used for the requests. The
+        transport shared by all API objects is used by default.
+
+        api_base is the base URL of the API (API_BASE by default).
         """
         self._consumer_key = key
         self._consumer_secret = secret
         if state is None:
             state = {}
         self.state = state
+        if transport is None:
+            transport = default_transport()
+        self.transport = transport
+        self.api_base = api_base
+        self._consumer = None
+        self._token = None
+        self._signature_method = oauth2.SignatureMethod_HMAC_SHA1()
+
+    def signed_post(self, u, d, token=None, idempotent=False):
+        """Make a POST request signed using OAuth
+
+        d is the urlencoded request body. Returns HttpResponse object.
+        If idempotent is True, the request may be sent again after a
+        failure.
+        """
+        req = oauth2.Request.from_consumer_and_token(self.oauth_consumer(), token=token,
+                                                     http_method='POST', http_url=u,
+                                                     parameters=urlparse.parse_qs(d),
+                                                     body=d, is_form_encoded=True)
+        req.sign_request(self._signature_method, self.oauth_consumer(), token)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        return self.transport.request('POST', u, req.to_postdata(), headers, idempotent=idempotent)
 
     def make_request(self, p, raw=False, **kwargs):
         """Make authenticated POST request"""
-        c = oauth2.Client(self.oauth_consumer(), self.oauth_token())
-        u = api_url(p)
+        u = api_url(p, api_base=self.api_base)
         d = urllib.urlencode(kwargs)
         dbg('making post request: url: %r, data: %r', u, d)
-        resp,content = c.request(u, 'POST', d)
-        dbg('returned data: %r', content)
-        return json.loads(content)
+        r = self.signed_post(u, d, self.oauth_token(), idempotent=p in READ_METHODS)
+        dbg('returned data: %r', r.body)
+        if r.status in (401, 403):
+            self.del_state('auth_verified')
+            raise PleaseReauthenticate()
+        r.raise_for_status()
+        return json.loads(r.body)
 
     def oauth_consumer(self):
-        return oauth2.Consumer(key=self._consumer_key, secret=self._consumer_secret)
+        if self._consumer is None:
+            self._consumer = oauth2.Consumer(key=self._consumer_key, secret=self._consumer_secret)
+        return self._consumer
 
     def oauth_token(self):
-        return oauth2.Token(key=self.state['oauth_token'], secret=self.state['oauth_token_secret'])
+        key, secret = self.state['oauth_token'], self.state['oauth_token_secret']
+        if self._token is None or (self._token.key, self._token.secret) != (key, secret):
+            self._token = oauth2.Token(key=key, secret=secret)
+        return self._token
 
     def del_state(self, key):
         if self.state.has_key(key):
@@ -79,15 +119,17 @@ class InstapaperApi:
     def reset_auth(self):
         self.del_state('oauth_token')
         self.del_state('oauth_token_secret')
+        self.del_state('auth_verified')
 
     def authenticate(self, username, password):
         """Authenticate using username and password
         """
-        c = oauth2.Client(self.oauth_consumer())
         args = dict(x_auth_username=username, x_auth_password=password, x_auth_mode='client_auth')
-        u = api_url('oauth/access_token')
+        u = api_url('oauth/access_token', api_base=self.api_base)
         dbg('auth url: %r', u)
-        resp, content = c.request(u, 'POST', urllib.urlencode(args))
+        r = self.signed_post(u, urllib.urlencode(args))
+        r.raise_for_status()
+        content = r.body
         dbg('auth response contents: %r', content)
         tokendata = dict(urlparse.parse_qsl(content))
         self.state['oauth_token'] = tokendata['oauth_token']
@@ -96,17 +138,28 @@ class InstapaperApi:
     def is_authenticated(self):
         return self.state.has_key('oauth_token') and self.state.has_key('oauth_token_secret')
 
-    def test_auth(self):
+    def test_auth(self, max_age=None):
         """Test authentication
 
         Returns True if it seems to be working.
         Returns False if it's obviously not working (and needs re-authentication).
         Raises an exception on unexpected errors (probably meaning that it needs re-authentication)
+
+        If max_age is set and the same token was verified less than
+        max_age seconds ago, no request is made. Requests rejected by the
+        server later discard the verification.
         """
         if not self.is_authenticated():
             return False
-        r = self.make_request('account/verify_credentials')
+        v = self.state.get('auth_verified')
+        if max_age and v and v['token'] == self.state['oauth_token'] and time.time() - v['time'] < max_age:
+            return True
+        try:
+            r = self.make_request('account/verify_credentials')
+        except PleaseReauthenticate:
+            return False
         if len(r) > 0 and r[0].get('type') == 'user' and r[0].has_key('user_id'):
+            self.state['auth_verified'] = dict(token=self.state['oauth_token'], time=int(time.time()))
             return True
         else:
             return False
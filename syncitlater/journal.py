@@ -0,0 +1,110 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Write-ahead journal for the commit phase of a synchronization"""
+import os
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+info = logger.info
+dbg = logger.debug
+
+
+class CommitJournal(object):
+    """Journal of the changes committed to each member
+
+    Before anything is committed, begin() saves the state (which already
+    includes the cursors advanced by the fetch phase) and the list of
+    changes for each member. Each chunk of changes committed to a member
+    is then recorded by record(), after saving the state again, so what
+    the members learned from the chunk (item IDs, known bookmarks) is
+    kept too. If the process dies before finish() is called, pending()
+    returns what is necessary to commit the remaining chunks on top of
+    the saved state. A chunk may be committed again if the process died
+    between saving the state and recording it.
+
+    The journal is a file with one JSON object per line, synced to disk
+    after each write. save is the function used to save the state.
+    """
+    def __init__(self, path, save=None, chunk_size=100):
+        self.path = path
+        self.save = save
+        self.chunk_size = chunk_size
+        self._f = None
+
+    def _write(self, entry):
+        self._f.write(json.dumps(entry) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _save(self):
+        if self.save is not None:
+            self.save()
+
+    def begin(self, plan):
+        """Start commit of a list of changes for each member"""
+        self._save()
+        self._f = open(self.path, 'w')
+        self._write(dict(type='begin', plan=plan, chunk_size=self.chunk_size))
+
+    def record(self, mid, start, end):
+        """Record that changes[start:end] were committed to member mid
+
+        The state must not be changing while this is called.
+        """
+        self._save()
+        if self._f is None:
+            self._f = open(self.path, 'a')
+        self._write(dict(type='done', member=mid, start=start, end=end))
+
+    def finish(self):
+        """The commit is complete, the journal is not necessary anymore"""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def pending(self):
+        """Check for an interrupted commit
+
+        Returns None if there's nothing to resume, or a (plan, done)
+        tuple, where done is a set of (member, start) pairs for the chunks
+        already committed. The chunk size of the journal is restored too.
+        """
+        if not os.path.exists(self.path):
+            return None
+        begin = None
+        done = set()
+        for line in open(self.path, 'r'):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if we crashed while writing it
+                break
+            if entry['type'] == 'begin':
+                begin = entry
+            elif entry['type'] == 'done':
+                done.add((entry['member'], entry['start']))
+        if begin is None:
+            return None
+        self.chunk_size = begin['chunk_size']
+        return begin['plan'], done
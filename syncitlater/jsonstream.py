@@ -0,0 +1,132 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Incremental decoding of large JSON objects"""
+import json
+
+_decoder = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+
+class _Reader(object):
+    """Buffered reader that decodes JSON values from a file-like object"""
+    def __init__(self, f, bufsize):
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read more data into the buffer. Returns False on EOF"""
+        if self.eof:
+            return False
+        data = self.f.read(self.bufsize)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, without consuming it"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON data')
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Unexpected character on JSON data: %r' % (c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                v, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may be incomplete
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return v
+
+
+def _members(r, close):
+    """Generate the (name, value) pairs of an object or list
+
+    The opening character must be already consumed. List items are
+    generated as (index, value) pairs.
+    """
+    if r.peek() == close:
+        r.pos += 1
+        return
+    i = 0
+    while True:
+        if close == '}':
+            name = r.value()
+            r.expect(':')
+        else:
+            name = i
+        yield name, r.value()
+        i += 1
+        if r.expect(',' + close) == close:
+            return
+
+
+def iter_object_items(f, key, rest=None, bufsize=65536):
+    """Generate (name, value) pairs of a member of a JSON object
+
+    f is a file-like object containing a JSON object. The pairs of the
+    object at the 'key' member are generated as they are decoded, without
+    keeping the whole document in memory. If the member is a list, its
+    items are generated as (index, value) pairs.
+
+    The other members of the document are stored on the 'rest' dictionary,
+    if provided.
+    """
+    r = _Reader(f, bufsize)
+    r.expect('{')
+    if r.peek() == '}':
+        return
+    while True:
+        name = r.value()
+        r.expect(':')
+        if name == key and r.peek() in '{[':
+            close = r.expect('{[') == '{' and '}' or ']'
+            for pair in _members(r, close):
+                yield pair
+        else:
+            v = r.value()
+            if rest is not None:
+                rest[name] = v
+        if r.expect(',}') == '}':
+            return
@@ -0,0 +1,86 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Sync plans: changes calculated on one run, to be committed later
+
+A plan file has the changes calculated for each member, the cursors of
+the members before the changes were fetched, and the state right after
+they were fetched. Applying a plan commits the changes and makes that
+state current, so the fetched changes are not fetched again.
+
+The state on the plan doesn't include the credentials (the API
+states): a plan may be reviewed and passed around, and applying it
+keeps the credentials of the current state.
+
+A plan can be applied only if the member cursors didn't change since it
+was calculated: otherwise another synchronization already happened and
+the plan is stale.
+
+Plan files are gzip-compressed JSON.
+"""
+import gzip
+import json
+import time
+
+PLAN_VERSION = 1
+
+# state fields that are never saved on a plan
+PRIVATE_FIELDS = ('api_states',)
+
+class StalePlan(Exception):
+    """The plan doesn't match the current state anymore"""
+    pass
+
+
+def save_plan(path, cursors, changes, state):
+    """Save a plan
+
+    cursors is the list of member cursors before the fetch (see
+    SyncEngine.cursors()), changes the list of changes for each member,
+    and state the state after the fetch (the PRIVATE_FIELDS are
+    not saved).
+    """
+    state = dict((k,v) for k,v in state.items() if k not in PRIVATE_FIELDS)
+    plan = dict(version=PLAN_VERSION, created=int(time.time()), cursors=cursors,
+                changes=[[dict(c) for c in l] for l in changes], state=state)
+    f = gzip.open(path, 'wb')
+    try:
+        json.dump(plan, f, separators=(',', ':'))
+    finally:
+        f.close()
+
+def load_plan(path):
+    """Load a plan saved by save_plan()"""
+    f = gzip.open(path, 'rb')
+    try:
+        plan = json.load(f)
+    finally:
+        f.close()
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('unsupported plan version: %r' % (plan.get('version')))
+    return plan
+
+def check_plan(plan, cursors):
+    """Raise StalePlan if the plan was calculated for other member cursors"""
+    if len(plan['cursors']) != len(cursors):
+        raise StalePlan('the plan has changes for %d members, not %d' % (len(plan['cursors']), len(cursors)))
+    for i,(old, new) in enumerate(zip(plan['cursors'], cursors)):
+        if old != new:
+            raise StalePlan('member %d was synchronized after the plan was calculated' % (i))
@@ -18,9 +18,11 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os
-import urllib2, urllib, urlparse
+import os, time
+import urllib, urlparse
 import json
+from transport import default_transport, PleaseReauthenticate
+import jsonstream
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,47 +32,54 @@ dbg = logger.debug
 API_BASE = 'https://getpocket.com/v3/'
 BROWSER_AUTH_URL = 'https://getpocket.com/auth/authorize'
 
+# API methods that only read data, so they can be sent again after a failure
+READ_METHODS = frozenset(['get'])
+
 def api_url(p, *args, **kwargs):
-    u = urlparse.urljoin(API_BASE, p)
+    base = kwargs.pop('api_base', None) or API_BASE
+    u = urlparse.urljoin(base, p)
     if args or kwargs:
         u += '?' + urllib.urlencode(args + kwargs.items())
     return u
 
-
-class PleaseReauthenticate(Exception):
-    pass
-
 class PocketApi:
-    def __init__(self, key, state=None):
+    def __init__(self, key, state=None, transport=None, api_base=None):
         """Constructor
 
         The state object is a dictionary-like object, that will be
         changed by the PocketApi in-place.
+
+        transport is the HttpTransport object used for the requests. The
+        transport shared by all API objects is used by default.
+
+        api_base is the base URL of the API (API_BASE by default).
         """
         self._consumer_key = key
         if state is None:
             state = {}
         self.state = state
+        if transport is None:
+            transport = default_transport()
+        self.transport = transport
+        self.api_base = api_base
+
+    def _post(self, p, args, stream=False):
+        u = api_url(p, api_base=self.api_base)
+        d = json.dumps(args)
+        dbg('making post request: url: %r, data: %r', u, d)
+        headers = {'Content-Type': 'application/json; charset=UTF8',
+                   'X-Accept': 'application/json'}
+        r = self.transport.request('POST', u, d, headers, stream=stream, idempotent=p in READ_METHODS)
+        if r.status == 401:
+            self.del_state('auth_verified')
+            raise PleaseReauthenticate()
+        r.raise_for_status()
+        return r
 
     def make_post(self, p, **kwargs):
-        u = api_url(p)
-        d = json.dumps(kwargs)
-        dbg('making post request: url: %r, data: %r', u, d)
-        r = urllib2.Request(u)
-        r.add_data(d)
-        r.add_header('Content-Type', 'application/json; charset=UTF8')
-        r.add_header('X-Accept', 'application/json')
-        dbg('urllib2 request: %r, headers: %r', r, r.header_items())
-        try:
-            f = urllib2.urlopen(r)
-            s = f.read()
-        except urllib2.HTTPError,e:
-            if e.code == 401:
-                raise PleaseReauthenticate()
-            else:
-                raise
-        dbg('returned data: %r', s)
-        return json.loads(s)
+        r = self._post(p, kwargs)
+        dbg('returned data: %r', r.body)
+        return json.loads(r.body)
 
     def _get_request_token(self, redir_uri, state=None):
         args = dict(consumer_key=self._consumer_key, redirect_uri=redir_uri)
@@ -88,6 +97,7 @@ class PocketApi:
         self.del_state('request_token')
         self.del_state('access_token')
         self.del_state('username')
+        self.del_state('auth_verified')
 
     def start_auth(self, redir_uri, state=None):
         """Start authentication process
@@ -113,33 +123,65 @@ class PocketApi:
     def is_authenticated(self):
         return self.state.has_key('username') and self.state.has_key('access_token')
 
-    def authenticated_post(self, p, **kwargs):
+    def _auth_args(self, **kwargs):
         assert self.is_authenticated()
-        return self.make_post(p,
-                              consumer_key=self._consumer_key,
-                              access_token=self.state['access_token'],
-                              **kwargs)
+        kwargs.update(consumer_key=self._consumer_key,
+                      access_token=self.state['access_token'])
+        return kwargs
+
+    def authenticated_post(self, p, **kwargs):
+        return self.make_post(p, **self._auth_args(**kwargs))
 
     def api_get(self, **kwargs):
         """Generic 'get' API method"""
         return self.authenticated_post('get', **kwargs)
 
+    def api_get_items(self, rest=None, **kwargs):
+        """'get' API method, generating the items as they are decoded
+
+        The whole response is never kept in memory. The other fields of
+        the response (e.g. 'since') are stored on the 'rest' dictionary,
+        if provided.
+        """
+        r = self._post('get', self._auth_args(**kwargs), stream=True)
+        try:
+            for item_id,item in jsonstream.iter_object_items(r.stream, 'list', rest):
+                yield item
+            # read what is left (e.g. the gzip trailer), so the
+            # connection can be reused
+            while r.stream.read():
+                pass
+        finally:
+            r.stream.close()
+
     def send_actions(self, actions):
-        return self.authenticated_post('send', actions=json.dumps(actions))
+        """Send a list of actions
+
+        Returns the response object, including the 'action_results' list.
+        """
+        return self.authenticated_post('send', actions=actions)
 
-    def test_auth(self):
+    def test_auth(self, max_age=None):
         """Test authentication
 
         Returns True if it seems to be working.
         Returns False if it's obviously not working (and needs re-authentication).
         Raises an exception on unexpected errors (probably meaning that it needs re-authentication)
+
+        If max_age is set and the same access token was verified less
+        than max_age seconds ago, no request is made. Requests rejected
+        by the server later discard the verification.
         """
         if not self.is_authenticated():
             return False
+        v = self.state.get('auth_verified')
+        if max_age and v and v['token'] == self.state['access_token'] and time.time() - v['time'] < max_age:
+            return True
         try:
             self.api_get(count=0)
         except PleaseReauthenticate:
             return False
+        self.state['auth_verified'] = dict(token=self.state['access_token'], time=int(time.time()))
         return True
 
 # below is just test code:
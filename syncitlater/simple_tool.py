@@ -19,44 +19,72 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 """Simple Instapaper<->Pocket sync tool"""
-import tempfile, os
+import os, sys, time
+import copy
 import json
-import sync, pocket, instapaper
+import threading, signal
+import sync, pocket, instapaper, statestore, transport, cassette, plan
+from stats import SyncStats
+from journal import CommitJournal
 import settings
 import logging
 
 class SimpleSync:
-    def __init__(self, statefile):
-        self.statefile = statefile
+    def __init__(self, store, journal_path=None, observer=None, transport=None):
+        """Constructor
+
+        store is the state storage backend (see the statestore module).
+        journal_path is the file used as commit journal, to finish
+        commits that were interrupted. observer is a stats.SyncObserver
+        object for the SyncEngine. transport is the HttpTransport used by
+        the API objects (the shared default transport if None).
+        """
+        self.store = store
+        self.journal_path = journal_path
+        self.observer = observer
+        self.transport = transport
+        # if True, the state is never saved
+        self.read_only = False
+        # set to make daemon() exit
+        self.stop = threading.Event()
 
     def load_state(self):
-        if os.path.exists(self.statefile):
-            self.state = json.load(open(self.statefile, 'r'))
-        else:
-            self.state = {}
+        self.state = self.store.load()
 
     def save_state(self):
-        tmpfile = tempfile.mktemp(self.statefile + '.tmp.XXXXXX')
-        try:
-            json.dump(self.state, open(tmpfile, 'w'))
-            os.rename(tmpfile, self.statefile)
-        finally:
-            try:
-                os.unlink()
-            except:
-                pass
+        if not self.read_only:
+            self.store.save(self.state)
 
-    def synchronize(self, args):
-        import settings
+    def load(self):
+        """Load the state and check for an interrupted commit"""
         self.load_state()
+        self.journal = None
+        if self.journal_path:
+            # the journal saves the state after each chunk committed, so
+            # an interrupted commit can be finished on top of the saved state
+            self.journal = CommitJournal(self.journal_path, self.save_state)
+            if self.journal.pending():
+                print 'The last commit was interrupted, it will be finished first.'
         self.state.setdefault('member_states', [{}, {}])
         self.state.setdefault('api_states', [{}, {}])
         self.state.setdefault('engine_state', {})
 
-        pocketapi = pocket.PocketApi(settings.POCKET_API_KEY, self.state['api_states'][0])
+    def make_apis(self):
+        self.pocketapi = pocket.PocketApi(settings.POCKET_API_KEY, self.state['api_states'][0],
+                                          transport=self.transport)
+        self.instapaperapi = instapaper.InstapaperApi(settings.INSTAPAPER_API_KEY, settings.INSTAPAPER_API_SECRET,
+                                                      self.state['api_states'][1], transport=self.transport)
+
+    def check_auth(self, max_age=None):
+        """Test authentication, asking for credentials if necessary
+
+        Credentials verified less than max_age seconds ago are not
+        tested again. Returns False if authentication failed.
+        """
+        pocketapi = self.pocketapi
         print 'Testing Pocket API:',
         sys.stdout.flush()
-        if pocketapi.test_auth():
+        if pocketapi.test_auth(max_age):
             print 'OK'
         else:
             print 'Failed.'
@@ -72,13 +100,13 @@ class SimpleSync:
             if not pocketapi.test_auth():
                 print "Something is really wrong: I still can't talk to the Pocket service. :-("
                 print "Aborting."
-                return 1
+                return False
             self.save_state()
 
-        instapaperapi = instapaper.InstapaperApi(settings.INSTAPAPER_API_KEY, settings.INSTAPAPER_API_SECRET, self.state['api_states'][1])
+        instapaperapi = self.instapaperapi
         print 'Testing Instapaper API:',
         sys.stdout.flush()
-        if instapaperapi.test_auth():
+        if instapaperapi.test_auth(max_age):
             print 'OK'
         else:
             print 'Failed.'
@@ -90,34 +118,223 @@ class SimpleSync:
             if not instapaperapi.test_auth():
                 print "Something is really wrong: I still can't talk to the Instapaper API. :-("
                 print "Aborting."
-                return 1
+                return False
             self.save_state()
+        return True
+
+    def make_engine(self, args, resume=True):
+        """Create the sync engine
 
-        m1 = sync.PocketMember(pocketapi, self.state['member_states'][0])
-        m2 = sync.InstapaperMember(instapaperapi, self.state['member_states'][1])
-        engine = sync.SyncEngine(self.state['engine_state'], [m1, m2])
-        result = list(engine.calculate_sync())
+        If resume is True, an interrupted commit is finished first.
+        """
+        m1 = sync.PocketMember(self.pocketapi, self.state['member_states'][0],
+                               send_workers=getattr(settings, 'POCKET_SEND_WORKERS', 1),
+                               initial_workers=getattr(settings, 'POCKET_INITIAL_WORKERS', 4))
+        m2 = sync.InstapaperMember(self.instapaperapi, self.state['member_states'][1],
+                                   commit_workers=getattr(settings, 'INSTAPAPER_COMMIT_WORKERS', 1),
+                                   commit_rate=getattr(settings, 'INSTAPAPER_COMMIT_RATE', None),
+                                   parallel_folders=args.parallel)
+        self.engine = sync.SyncEngine(self.state['engine_state'], [m1, m2],
+                                      parallel=args.parallel, fetch_timeout=args.fetch_timeout,
+                                      journal=self.journal, observer=self.observer)
+        if resume:
+            self.resume()
 
+    def resume(self):
+        """Finish an interrupted commit, if there is one"""
+        if self.engine.resume_sync():
+            self.save_state()
+
+    def setup(self, args, resume=True):
+        """Load state, check authentication and create the sync engine
+
+        Returns False if authentication failed.
+        """
+        self.load()
+        self.make_apis()
+        verified = [s.get('auth_verified') for s in self.state['api_states']]
+        if self.read_only:
+            # replaying a cassette: the requests to test authentication
+            # were probably not recorded
+            pass
+        elif not self.check_auth(args.auth_ttl):
+            return False
+        if [s.get('auth_verified') for s in self.state['api_states']] != verified:
+            # keep the verification time, even on dry-run mode
+            self.save_state()
+        self.make_engine(args, resume)
+        return True
+
+    def show_changes(self, result, verbose=True):
         counts = [{} for r in result]
         for i,(member, changes) in enumerate(result):
-            print 'member: %r' % (member)
-            print 'changes:'
+            if verbose:
+                print 'member: %r' % (member)
+                print 'changes:'
             for c in changes:
-                print '%r' % (c)
+                if verbose:
+                    print '%r' % (c)
                 counts[i].setdefault(c['state'], 0)
                 counts[i][c['state']] += 1
-            print '---'
+            if verbose:
+                print '---'
         print 'Summary:'
         for (member, changes), ct in zip(result, counts):
             print 'member: %r, %d changes [%s]' % (member, len(changes), ', '.join(['%s: %d' % (k, c) for k,c in ct.items()]))
 
+    def run_once(self, args, verbose=True, save=True):
+        """Calculate and (unless on dry-run mode) commit a synchronization
+
+        The state is saved after commit. If save is False, it is saved
+        only if there was something to commit. Returns the number of
+        changes.
+        """
+        cursors = self.engine.cursors()
+        result = list(self.engine.calculate_sync())
+        self.show_changes(result, verbose)
+        count = sum(len(changes) for member,changes in result)
+
+        plan_out = getattr(args, 'plan_out', None)
+        if plan_out:
+            plan.save_plan(plan_out, cursors, [changes for member,changes in result], self.state)
+            print 'Plan saved to %s' % (plan_out)
+
         if args.interactive:
             r = raw_input('Commit? (y/n) ')
             args.dry_run = (not r.lower().startswith('y'))
 
         if not args.dry_run:
-            engine.commit_sync(result)
+            self.engine.commit_sync(result)
+            if save or count:
+                self.save_state()
+        return count
+
+    def synchronize(self, args):
+        if not self.setup(args):
+            return 1
+        try:
+            self.run_once(args)
+        except transport.PleaseReauthenticate:
+            # the cached authentication check was wrong. Start again from
+            # the saved state, really checking the credentials this time
+            print 'Credentials rejected by the service, testing authentication again.'
+            args.auth_ttl = 0
+            if not self.setup(args):
+                return 1
+            self.run_once(args)
+
+    def apply_plan(self, args):
+        """Commit the changes from the plan file args.apply, without fetching anything"""
+        if not self.setup(args):
+            return 1
+        p = plan.load_plan(args.apply)
+        try:
+            return self.commit_plan(p, args)
+        except transport.PleaseReauthenticate:
+            print 'Credentials rejected by the service, testing authentication again.'
+            args.auth_ttl = 0
+            # if the commit had started, the plan state was saved, and
+            # setup() finishes the commit from the journal
+            started = self.journal is not None and self.journal.pending() is not None
+            if not self.setup(args):
+                return 1
+            if started:
+                return 0
+            return self.commit_plan(p, args)
+
+    def commit_plan(self, p, args):
+        """Commit the changes from a plan loaded by plan.load_plan(), if it's not stale"""
+        try:
+            plan.check_plan(p, self.engine.cursors())
+        except plan.StalePlan, e:
+            print 'The plan is stale (%s), it must be calculated again.' % (e)
+            return 1
+        # the state right after the plan was fetched becomes the current
+        # one, but keep the current credentials
+        state = copy.deepcopy(p['state'])
+        state['api_states'] = self.state['api_states']
+        self.state.clear()
+        self.state.update(state)
+        self.make_apis()
+        self.make_engine(args)
+
+        result = zip(self.engine.members, [[sync.Change(c) for c in changes] for changes in p['changes']])
+        self.show_changes(result, verbose=False)
+        self.engine.commit_sync(result)
+        self.save_state()
+        return 0
+
+    def daemon(self, args):
+        """Synchronize periodically, until SIGTERM is received
+
+        The next run happens args.interval seconds after a run that found
+        changes, and the interval doubles after each idle (or failed) run,
+        up to args.max_interval. The state is saved after every commit,
+        and every args.flush_interval seconds (and on exit) otherwise.
+        """
+        # an interrupted commit is finished by the first run, so a
+        # failure is handled like any other failed run
+        if not self.setup(args, resume=False):
+            return 1
+        args.dry_run = False
+        args.interactive = False
+
+        stop = self.stop
+        def handle_sigterm(signum, frame):
+            logging.info('SIGTERM received, exiting')
+            stop.set()
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        # let the current run finish: don't make blocking socket calls
+        # fail with EINTR
+        signal.siginterrupt(signal.SIGTERM, False)
+
+        interval = args.interval
+        last_flush = time.time()
+        dirty = False
+        while not stop.is_set():
+            try:
+                self.resume()
+                count = self.run_once(args, verbose=False, save=False)
+            except Exception:
+                logging.exception('Synchronization failed')
+                # the state in memory may be half-updated. Go back to
+                # the last saved state; an interrupted commit is
+                # finished on the next run
+                self.load()
+                self.make_apis()
+                self.make_engine(args, resume=False)
+                dirty = False
+                count = 0
+            else:
+                if count:
+                    last_flush = time.time()
+                    dirty = False
+                else:
+                    dirty = True
+            if count:
+                interval = args.interval
+            else:
+                interval = min(interval * 2, args.max_interval)
+
+            logging.info('Next synchronization in %g seconds', interval)
+            next_run = time.time() + interval
+            while not stop.is_set():
+                now = time.time()
+                if dirty and now - last_flush >= args.flush_interval:
+                    self.save_state()
+                    last_flush = now
+                    dirty = False
+                wait = next_run - now
+                if dirty:
+                    # wake up in time to save the state
+                    wait = min(wait, last_flush + args.flush_interval - now)
+                if wait <= 0:
+                    break
+                stop.wait(wait)
+
+        if dirty:
             self.save_state()
+        return 0
 
 def main(argv):
     import argparse
@@ -127,15 +344,83 @@ def main(argv):
     parser.add_argument('-X', '--commit', dest='dry_run', action='store_false', default=True)
     parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=True)
     parser.add_argument('-d', '--debug', dest='debug', action='store_true')
+    parser.add_argument('--stats', dest='stats', metavar='FILE',
+                        help='write a JSON report with timings and API usage to FILE')
+    parser.add_argument('--state-db', dest='state_db', metavar='FILE',
+                        help='keep state on a SQLite database (migrated from simplesync.json if needed)')
+    parser.add_argument('-P', '--parallel', dest='parallel', action='store_true',
+                        help='fetch changes from (and commit changes to) all services at the same time')
+    parser.add_argument('--fetch-timeout', dest='fetch_timeout', type=float, metavar='SECONDS',
+                        help='maximum time to fetch changes from each service (with --parallel)')
+    parser.add_argument('--auth-ttl', dest='auth_ttl', type=float, default=86400, metavar='SECONDS',
+                        help="don't test credentials verified less than SECONDS ago (0 to always test)")
+    parser.add_argument('--record', dest='record', metavar='FILE',
+                        help='record the API requests and responses (except authentication) to the cassette FILE')
+    parser.add_argument('--replay', dest='replay', metavar='FILE',
+                        help='answer API requests using the cassette FILE, without network access '
+                             '(implies --dry-run, and the state is not saved)')
+    parser.add_argument('--plan-out', dest='plan_out', metavar='FILE',
+                        help='save the calculated changes to the plan FILE, to be applied later (implies --dry-run)')
+    parser.add_argument('--apply', dest='apply', metavar='PLAN',
+                        help="commit the changes from a plan file, if it's not stale")
+    parser.add_argument('--daemon', dest='daemon', action='store_true',
+                        help='keep running, synchronizing and committing changes periodically')
+    parser.add_argument('--interval', dest='interval', type=float, default=300, metavar='SECONDS',
+                        help='interval between synchronizations after changes were found (with --daemon)')
+    parser.add_argument('--max-interval', dest='max_interval', type=float, default=3600, metavar='SECONDS',
+                        help='maximum interval between synchronizations when idle (with --daemon)')
+    parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=600, metavar='SECONDS',
+                        help='maximum time between state saves (with --daemon)')
     args = parser.parse_args(argv[1:])
+    if args.replay:
+        if args.record or args.daemon:
+            parser.error('--replay cannot be used with --record or --daemon')
+        args.dry_run = True
+        args.interactive = False
+    if args.apply and (args.plan_out or args.replay or args.daemon):
+        parser.error('--apply cannot be used with --plan-out, --replay or --daemon')
+    if args.plan_out:
+        if args.daemon:
+            parser.error('--plan-out cannot be used with --daemon')
+        args.dry_run = True
+        args.interactive = False
 
     loglevel = logging.INFO
     if args.debug:
         loglevel = logging.DEBUG
     logging.basicConfig(level=loglevel)
-    s = SimpleSync('simplesync.json')
-    return s.synchronize(args)
+    statefile = 'simplesync.json'
+    if args.state_db:
+        if not os.path.exists(args.state_db) and os.path.exists(statefile):
+            store = statestore.migrate_json(statefile, args.state_db)
+        else:
+            store = statestore.SqliteStateStore(args.state_db)
+    else:
+        store = statestore.JsonStateStore(statefile)
+    stats = None
+    if args.stats:
+        stats = SyncStats()
+        transport.default_transport().observer = stats
+    t = None
+    if args.record:
+        t = cassette.RecordingTransport(transport.default_transport(), args.record)
+    elif args.replay:
+        t = cassette.ReplayTransport(args.replay)
+    journal = not args.replay and store.path + '.journal' or None
+    s = SimpleSync(store, journal, stats, t)
+    s.read_only = bool(args.replay)
+    try:
+        if args.daemon:
+            return s.daemon(args)
+        if args.apply:
+            return s.apply_plan(args)
+        return s.synchronize(args)
+    finally:
+        store.close()
+        if t:
+            t.close()
+        if stats:
+            json.dump(stats.report(), open(args.stats, 'w'), indent=1, sort_keys=True)
 
 if __name__ == '__main__':
-    import sys
     sys.exit(main(sys.argv))
@@ -0,0 +1,294 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Storage backends for the synchronization state
+
+The state is a dictionary, containing dictionaries (or lists of
+dictionaries) used as the state of each API and sync member. Backends
+load the whole state as plain dictionaries and lists, so the code using
+it doesn't need to know which backend is in use.
+"""
+import os
+import tempfile
+import json
+import sqlite3
+
+import logging
+logger = logging.getLogger(__name__)
+info = logger.info
+dbg = logger.debug
+
+
+class JsonStateStore(object):
+    """State stored on a single JSON file, rewritten on every save"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if os.path.exists(self.path):
+            return json.load(open(self.path, 'r'))
+        else:
+            return {}
+
+    def save(self, state):
+        fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.tmp.',
+                                       dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            f = os.fdopen(fd, 'w')
+            json.dump(state, f)
+            f.close()
+            os.rename(tmpfile, self.path)
+        except:
+            os.unlink(tmpfile)
+            raise
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scopes (scope TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS state_values (
+    scope TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+    PRIMARY KEY (scope, key));
+CREATE TABLE IF NOT EXISTS known_bookmarks (
+    scope TEXT NOT NULL, seq INTEGER NOT NULL,
+    url TEXT, bookmark_id, hash, folder_id TEXT, extra TEXT,
+    PRIMARY KEY (scope, seq));
+CREATE INDEX IF NOT EXISTS known_bookmarks_url ON known_bookmarks (scope, url);
+CREATE INDEX IF NOT EXISTS known_bookmarks_id ON known_bookmarks (scope, bookmark_id);
+CREATE INDEX IF NOT EXISTS known_bookmarks_folder ON known_bookmarks (scope, folder_id);
+CREATE TABLE IF NOT EXISTS url_item_ids (
+    scope TEXT NOT NULL, url TEXT NOT NULL, item_id,
+    PRIMARY KEY (scope, url));
+CREATE TABLE IF NOT EXISTS url_maps (
+    scope TEXT NOT NULL, name TEXT NOT NULL, url TEXT NOT NULL, value TEXT NOT NULL,
+    PRIMARY KEY (scope, name, url));
+CREATE TABLE IF NOT EXISTS warnings (
+    scope TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT,
+    PRIMARY KEY (scope, seq));
+"""
+
+# known_bookmarks fields stored on their own columns
+BOOKMARK_FIELDS = ('url', 'bookmark_id', 'hash', 'folder_id')
+
+# dictionaries keyed by URL stored on the url_maps table, one row per URL
+URL_MAPS = ('url_aliases', 'recent_commits', 'rejected_urls')
+
+def _copy_value(v):
+    if isinstance(v, list):
+        return list(v)
+    return v
+
+def _bookmark_row(e):
+    extra = dict((k,v) for k,v in e.items() if k not in BOOKMARK_FIELDS)
+    return tuple(e.get(k) for k in BOOKMARK_FIELDS) + (extra and json.dumps(extra, sort_keys=True) or None,)
+
+def _bookmark_entry(row):
+    e = dict((k,v) for k,v in zip(BOOKMARK_FIELDS, row) if v is not None)
+    if row[-1]:
+        e.update(json.loads(row[-1]))
+    return e
+
+
+def _scopes(state):
+    """Generate (scope, dictionary) pairs for the dictionaries on a state
+
+    Dictionaries on the top level of the state are scope 'name', and
+    lists of dictionaries are scopes 'name/index'. The top level
+    dictionary itself is scope ''.
+    """
+    yield '', state
+    for k,v in state.items():
+        if isinstance(v, dict):
+            yield k, v
+        elif isinstance(v, list) and v and all(isinstance(i, dict) for i in v):
+            for i,d in enumerate(v):
+                yield '%s/%d' % (k, i), d
+
+def _scope_dict(state, scope):
+    """Find (or create) the dictionary for a scope on the state"""
+    if scope == '':
+        return state
+    if '/' in scope:
+        name, i = scope.rsplit('/', 1)
+        l = state.setdefault(name, [])
+        while len(l) <= int(i):
+            l.append({})
+        return l[int(i)]
+    return state.setdefault(scope, {})
+
+def _is_scope_container(scope, key, value):
+    return scope == '' and (isinstance(value, dict) or
+                            (isinstance(value, list) and value and all(isinstance(i, dict) for i in value)))
+
+
+class SqliteStateStore(object):
+    """State stored on a SQLite database
+
+    The big collections ('known_bookmarks', 'url_item_ids', 'warnings',
+    and the URL_MAPS dictionaries of each scope) are stored on their own
+    indexed tables, and everything
+    else as JSON values. Saving only writes what changed since the last
+    load() or save().
+
+    Warnings are never loaded by load(): new warnings appended to the
+    'warnings' lists are added to the database on save(). Use warnings()
+    to read them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self._reset_snapshot()
+
+    def _reset_snapshot(self):
+        self._scopes = set()
+        self._values = {}     # scope -> {key: json}
+        self._bookmarks = {}  # scope -> list of rows
+        self._item_ids = {}   # scope -> dict
+        self._url_maps = {}   # (scope, name) -> dict
+        self._warnings = {}   # scope -> (number of items already saved, next seq)
+
+    def close(self):
+        self.db.close()
+
+    def load(self):
+        self._reset_snapshot()
+        state = {}
+        for scope, in self.db.execute('SELECT scope FROM scopes ORDER BY scope'):
+            _scope_dict(state, scope)
+            self._scopes.add(scope)
+        for scope,key,value in self.db.execute('SELECT scope, key, value FROM state_values'):
+            _scope_dict(state, scope)[key] = json.loads(value)
+            self._values.setdefault(scope, {})[key] = value
+        rows = self.db.execute('SELECT scope, url, bookmark_id, hash, folder_id, extra '
+                               'FROM known_bookmarks ORDER BY scope, seq')
+        for r in rows:
+            scope = r[0]
+            _scope_dict(state, scope).setdefault('known_bookmarks', []).append(_bookmark_entry(r[1:]))
+            self._bookmarks.setdefault(scope, []).append(tuple(r[1:]))
+        for scope,url,item_id in self.db.execute('SELECT scope, url, item_id FROM url_item_ids'):
+            _scope_dict(state, scope).setdefault('url_item_ids', {})[url] = item_id
+            self._item_ids.setdefault(scope, {})[url] = item_id
+        for scope,name,url,value in self.db.execute('SELECT scope, name, url, value FROM url_maps'):
+            v = json.loads(value)
+            _scope_dict(state, scope).setdefault(name, {})[url] = v
+            self._url_maps.setdefault((scope, name), {})[url] = _copy_value(v)
+        return state
+
+    def warnings(self, scope):
+        """Return the list of warnings saved for a scope"""
+        rows = self.db.execute('SELECT message FROM warnings WHERE scope = ? ORDER BY seq', (scope,))
+        return [m for m, in rows]
+
+    def save(self, state):
+        with self.db:
+            for scope,d in _scopes(state):
+                if scope not in self._scopes:
+                    self.db.execute('INSERT OR IGNORE INTO scopes VALUES (?)', (scope,))
+                    self._scopes.add(scope)
+                self._save_scope(scope, d)
+
+    def _save_scope(self, scope, d):
+        values = self._values.setdefault(scope, {})
+        saved_keys = set()
+        for key,v in d.items():
+            if _is_scope_container(scope, key, v):
+                continue
+            if key == 'known_bookmarks' and isinstance(v, list):
+                self._save_bookmarks(scope, v)
+            elif key == 'url_item_ids' and isinstance(v, dict):
+                self._save_item_ids(scope, v)
+            elif key == 'warnings' and isinstance(v, list):
+                self._save_warnings(scope, v)
+            elif key in URL_MAPS and isinstance(v, dict):
+                self._save_url_map(scope, key, v)
+            else:
+                saved_keys.add(key)
+                js = json.dumps(v, sort_keys=True)
+                if values.get(key) != js:
+                    self.db.execute('INSERT OR REPLACE INTO state_values VALUES (?, ?, ?)', (scope, key, js))
+                    values[key] = js
+        for key in set(values.keys()) - saved_keys:
+            self.db.execute('DELETE FROM state_values WHERE scope = ? AND key = ?', (scope, key))
+            del values[key]
+        if not d.has_key('known_bookmarks'):
+            self._save_bookmarks(scope, [])
+        if not d.has_key('url_item_ids'):
+            self._save_item_ids(scope, {})
+        for name in URL_MAPS:
+            if not isinstance(d.get(name), dict):
+                self._save_url_map(scope, name, {})
+
+    def _save_bookmarks(self, scope, entries):
+        old = self._bookmarks.get(scope, [])
+        rows = [_bookmark_row(e) for e in entries]
+        changed = [(scope, i) + r for i,r in enumerate(rows) if i >= len(old) or old[i] != r]
+        if changed:
+            self.db.executemany('INSERT OR REPLACE INTO known_bookmarks VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+        if len(old) > len(rows):
+            self.db.execute('DELETE FROM known_bookmarks WHERE scope = ? AND seq >= ?', (scope, len(rows)))
+        self._bookmarks[scope] = rows
+
+    def _save_item_ids(self, scope, item_ids):
+        old = self._item_ids.get(scope, {})
+        changed = [(scope, url, i) for url,i in item_ids.iteritems() if old.get(url, None) != i or not old.has_key(url)]
+        if changed:
+            self.db.executemany('INSERT OR REPLACE INTO url_item_ids VALUES (?, ?, ?)', changed)
+        removed = [(scope, url) for url in old if not item_ids.has_key(url)]
+        if removed:
+            self.db.executemany('DELETE FROM url_item_ids WHERE scope = ? AND url = ?', removed)
+        self._item_ids[scope] = dict(item_ids)
+
+    def _save_url_map(self, scope, name, d):
+        old = self._url_maps.get((scope, name), {})
+        missing = object()
+        changed = [(scope, name, url, json.dumps(v)) for url,v in d.iteritems() if old.get(url, missing) != v]
+        removed = [(scope, name, url) for url in old if not d.has_key(url)]
+        if not changed and not removed:
+            return
+        self.db.executemany('INSERT OR REPLACE INTO url_maps VALUES (?, ?, ?, ?)', changed)
+        if removed:
+            self.db.executemany('DELETE FROM url_maps WHERE scope = ? AND name = ? AND url = ?', removed)
+        self._url_maps[(scope, name)] = dict((url, _copy_value(v)) for url,v in d.iteritems())
+
+    def _save_warnings(self, scope, warnings):
+        if not self._warnings.has_key(scope):
+            nextseq, = self.db.execute('SELECT COALESCE(MAX(seq) + 1, 0) FROM warnings WHERE scope = ?',
+                                       (scope,)).fetchone()
+            self._warnings[scope] = (0, nextseq)
+        saved, nextseq = self._warnings[scope]
+        new = warnings[saved:]
+        if new:
+            self.db.executemany('INSERT INTO warnings VALUES (?, ?, ?)',
+                                [(scope, nextseq + i, m) for i,m in enumerate(new)])
+        self._warnings[scope] = (len(warnings), nextseq + len(new))
+
+
+def migrate_json(json_path, db_path):
+    """Copy the state from a JSON state file to a new SQLite database"""
+    state = JsonStateStore(json_path).load()
+    store = SqliteStateStore(db_path)
+    store.save(state)
+    info('State migrated from %s to %s', json_path, db_path)
+    return store
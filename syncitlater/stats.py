@@ -0,0 +1,89 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Instrumentation of synchronization runs"""
+import time
+import threading
+
+
+class SyncObserver(object):
+    """Receives events from a synchronization run
+
+    SyncEngine, the sync members and HttpTransport report events to an
+    observer object. All methods do nothing by default. Methods may be
+    called from multiple threads.
+    """
+    def phase_finished(self, phase, duration, items=0, member=None):
+        """A phase of the synchronization has finished
+
+        phase is 'fetch', 'conflicts', 'fanout' or 'commit'. items is the
+        number of changes handled, and member the name of the member the
+        phase refers to (if any).
+        """
+        pass
+
+    def api_call(self, host, method, path, status, duration, bytes_out, bytes_in):
+        """A HTTP request was made
+
+        bytes_in is the size of the response body as sent by the server
+        (before decompression).
+        """
+        pass
+
+    def count(self, name, n=1, member=None):
+        """Generic event counter"""
+        pass
+
+
+class SyncStats(SyncObserver):
+    """Observer that collects all events on a structured report"""
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self.api = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def phase_finished(self, phase, duration, items=0, member=None):
+        with self._lock:
+            self.phases.append(dict(phase=phase, member=member, duration=duration, items=items))
+
+    def api_call(self, host, method, path, status, duration, bytes_out, bytes_in):
+        with self._lock:
+            h = self.api.setdefault(host, dict(calls=0, errors=0, duration=0.0,
+                                               bytes_out=0, bytes_in=0, paths={}))
+            h['calls'] += 1
+            if status >= 400:
+                h['errors'] += 1
+            h['duration'] += duration
+            h['bytes_out'] += bytes_out
+            h['bytes_in'] += bytes_in
+            h['paths'][path] = h['paths'].get(path, 0) + 1
+
+    def count(self, name, n=1, member=None):
+        with self._lock:
+            key = member and '%s.%s' % (member, name) or name
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def report(self):
+        """Return the collected data as a JSON-serializable dictionary"""
+        with self._lock:
+            return dict(started=self.started, duration=time.time() - self.started,
+                        phases=list(self.phases), api=dict(self.api), counters=dict(self.counters))
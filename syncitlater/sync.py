@@ -18,8 +18,15 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import copy
+import sys, time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
 import instapaper, pocket
+import dispatch, transport, urls
+from urls import canonical_url
+from stats import SyncObserver
 
 import logging
 logger = logging.getLogger(__name__)
@@ -27,113 +34,542 @@ info = logger.info
 dbg = logger.debug
 warn = logger.warn
 
+class Change(dict):
+	"""A change to be synchronized
+
+	Change objects are immutable, so the same object can be shared by
+	all the members it is sent to. Use replace() to get a modified copy.
+	"""
+	__slots__ = ('_hash',)
+
+	def _readonly(self, *args, **kwargs):
+		raise TypeError('Change objects are immutable')
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+	def __hash__(self):
+		try:
+			return self._hash
+		except AttributeError:
+			try:
+				self._hash = hash(frozenset(self.iteritems()))
+			except TypeError:
+				# some values are not hashable (lists, dictionaries)
+				self._hash = hash(json.dumps(self, sort_keys=True))
+			return self._hash
+
+	def __reduce__(self):
+		return (Change, (dict(self),))
+
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def replace(self, **kwargs):
+		"""Return a copy of the change, with some fields replaced"""
+		d = dict(self)
+		d.update(kwargs)
+		return Change(d)
+
+
+class FetchCancelled(Exception):
+	pass
+
+class FetchGuard(object):
+	"""Lets a get_changes() call running on another thread be abandoned
+
+	Members make each change to their state during get_changes() inside
+	a 'with guard:' block. Once cancel() returns, no block is running and
+	the next one raises FetchCancelled, so the state is left alone.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.cancelled = False
+
+	def cancel(self):
+		with self._lock:
+			self.cancelled = True
+
+	def check(self):
+		"""Raise FetchCancelled if the fetch was abandoned"""
+		if self.cancelled:
+			raise FetchCancelled()
+
+	def __enter__(self):
+		self._lock.acquire()
+		if self.cancelled:
+			self._lock.release()
+			raise FetchCancelled()
+
+	def __exit__(self, *exc):
+		self._lock.release()
+
+
 class SyncMember(object):
+	# the SyncEngine sets this to its own observer
+	observer = SyncObserver()
+
+	# how long (in seconds) committed changes are remembered, to
+	# recognize them when the service reports them back
+	echo_ttl = 7 * 24 * 3600
+
 	def __init__(self, state):
 		self.state = state
+		# the SyncEngine replaces this with its own index
+		self.url_index = urls.UrlIndex()
+		# the SyncEngine replaces this before each parallel fetch
+		self.fetch_guard = FetchGuard()
+
+	def count(self, name, n=1):
+		"""Report an event counter to the observer"""
+		self.observer.count(name, n, member=self.__class__.__name__)
 
 	def warn(self, message):
 		"""Log a warning about a sync operation"""
 		self.state.setdefault('warnings', []).append(message)
 		warn(message)
 
+	def remember_commit(self, url, state):
+		"""Remember a change that was committed to the service
+
+		The service will report the change back on the next
+		get_changes() call; is_echo() will recognize it.
+		"""
+		self.state.setdefault('recent_commits', {})[canonical_url(url)] = [state, int(time.time())]
+
+	def expire_commits(self):
+		"""Forget committed changes older than echo_ttl"""
+		recent = self.state.get('recent_commits')
+		if not recent:
+			return
+		limit = time.time() - self.echo_ttl
+		for url in [url for url,(state, t) in recent.items() if t < limit]:
+			del recent[url]
+
+	def is_echo(self, url, state):
+		"""Check if a change is just one of our own commits coming back
+
+		The remembered commit is forgotten as soon as the service
+		reports the URL, whatever its state, so later changes to the
+		same item are not lost.
+		"""
+		recent = self.state.get('recent_commits')
+		if not recent or url is None:
+			return False
+		commit = recent.pop(canonical_url(url), None)
+		if commit is None or commit[0] != state:
+			return False
+		self.count('echoes')
+		return True
+
 	def get_changes(self):
 		"""Return changes since the last synchronization"""
 		raise NotImplementedError()
 
+	def sync_cursor(self):
+		"""Return a JSON-compatible value identifying where get_changes() will start
+
+		Changes calculated for a cursor are still valid only if the
+		cursor didn't change.
+		"""
+		return None
+
+
+class KnownBookmarkIndex(object):
+	"""Index for the 'known_bookmarks' list of an InstapaperMember state
+
+	The list on the state dictionary is still the storage for the
+	entries (so the state file format doesn't change); this object just
+	keeps lookup tables by URL (in canonical form), by bookmark_id and per
+	folder on top of it. The index is rebuilt automatically if the list is replaced on the state.
+	"""
+	def __init__(self, state):
+		self.state = state
+		self._entries = None
+
+	def _rebuild(self):
+		self._entries = self.state.setdefault('known_bookmarks', [])
+		self._count = len(self._entries)
+		self._by_url = {}
+		self._by_id = {}
+		self._folders = {}
+		self._have = {} # folder_id -> [list of 'id:hash' items, joined string]
+		for e in self._entries:
+			self._index_entry(e)
+
+	def _check(self):
+		entries = self.state.get('known_bookmarks')
+		if entries is None or entries is not self._entries or len(entries) != self._count:
+			self._rebuild()
+
+	def _index_entry(self, e):
+		if e.has_key('url'):
+			self._by_url[canonical_url(e['url'])] = e
+		if e.has_key('bookmark_id'):
+			self._by_id[e['bookmark_id']] = e
+		folder_id = e.get('folder_id', 'unread')
+		folder = self._folders.setdefault(folder_id, OrderedDict())
+		folder[id(e)] = e
+		have = self._have.get(folder_id)
+		if have is not None:
+			have[0].append(self._have_item(e))
+			have[1] = None
+
+	def _unindex_entry(self, e):
+		if e.has_key('url') and self._by_url.get(canonical_url(e['url'])) is e:
+			del self._by_url[canonical_url(e['url'])]
+		if e.has_key('bookmark_id') and self._by_id.get(e['bookmark_id']) is e:
+			del self._by_id[e['bookmark_id']]
+		folder = self._folders.get(e.get('folder_id', 'unread'))
+		if folder is not None:
+			folder.pop(id(e), None)
+		# entries are rarely removed from a folder. Just build the
+		# 'have' list again next time
+		self._have.pop(e.get('folder_id', 'unread'), None)
+
+	def find(self, url=None, bookmark_id=None):
+		"""Find a known bookmark entry by URL or by bookmark_id"""
+		self._check()
+		e = None
+		if url is not None:
+			e = self._by_url.get(canonical_url(url))
+		if e is None and bookmark_id is not None:
+			e = self._by_id.get(bookmark_id)
+		return e
+
+	def folder(self, folder_id):
+		"""Return the known bookmark entries for a folder"""
+		self._check()
+		return self._folders.get(folder_id, {}).values()
+
+	@staticmethod
+	def _have_item(e):
+		return '%s:%s' % (e['bookmark_id'], e['hash'])
+
+	def have(self, folder_id):
+		"""Return the 'have' argument (list of id:hash items) for a folder
+
+		The list is built once and kept up to date as bookmarks are
+		added to the folder, and the joined string is kept until the
+		list changes.
+		"""
+		self._check()
+		have = self._have.get(folder_id)
+		if have is None:
+			have = [[self._have_item(e) for e in self.folder(folder_id)], None]
+			self._have[folder_id] = have
+		if have[1] is None:
+			have[1] = ','.join(have[0])
+		return have[1]
+
+	def add(self, b, folder_id):
+		"""Add or update entry for a bookmark returned by the API"""
+		entry = self.find(b['url'], b['bookmark_id'])
+		if entry is None:
+			entry = dict(url=b['url'])
+			self._entries.append(entry)
+			self._count += 1
+		else:
+			self._unindex_entry(entry)
+		entry.update(url=b['url'], bookmark_id=b['bookmark_id'], hash=b['hash'], folder_id=folder_id)
+		self._index_entry(entry)
+		return entry
+
 
 class InstapaperMember(SyncMember):
-	def __init__(self, api, state):
+	# (folder_id, change state) pairs
+	FOLDERS = [('unread', 'unread'), ('archive', 'archived')]
+
+	def __init__(self, api, state, page_size=500, paginate=True, commit_workers=1, commit_rate=None,
+	             parallel_folders=False):
+		"""Constructor
+
+		page_size is the 'limit' argument used on bookmarks/list calls.
+		If paginate is True, bookmarks/list is called repeatedly until
+		each folder is drained, instead of just once per folder. If
+		parallel_folders is True, all folders are fetched at the same time.
+
+		commit_workers is the number of bookmarks/add requests that may
+		be in flight at the same time, and commit_rate the maximum
+		number of bookmarks/add requests per second (None for no limit).
+		"""
 		self.api = api
+		self.page_size = page_size
+		self.paginate = paginate
+		self.commit_workers = commit_workers
+		self.commit_rate = commit_rate
+		self.parallel_folders = parallel_folders
 		super(InstapaperMember, self).__init__(state)
+		self.known_bookmarks = KnownBookmarkIndex(state)
 
 	def _have(self, folder_id='unread'):
 		"""Generate 'have' argument for instalaper API call"""
-		items = []
-		for i in self.state.get('known_bookmarks', []):
-			if i.get('folder_id', 'unread') == folder_id:
-				items.append('%s:%s' % (i['bookmark_id'], i['hash']))
-		return ','.join(items)
+		return self.known_bookmarks.have(folder_id)
+
+	def sync_cursor(self):
+		h = hashlib.sha1()
+		for folder_id, state in self.FOLDERS:
+			h.update('%s:%s\n' % (folder_id, self._have(folder_id)))
+		return h.hexdigest()
 
 	def _find_known_bookmark(self, url):
-		for b in self.state.get('known_bookmarks', []):
-			if b.get('url') == url:
-				return b
+		e = self.known_bookmarks.find(url)
+		if e is None:
+			for alias in self.url_index.aliases(url):
+				e = self.known_bookmarks.find(alias)
+				if e is not None:
+					break
+		return e
 
 	def _add_known_bookmark(self, b, folder_id):
-		entry = self._find_known_bookmark(b['url'])
-		if entry is None:
-			entry = dict(url=b['url'])
-			self.state.setdefault('known_bookmarks', []).append(entry)
-		entry.update(url=b['url'], bookmark_id=b['bookmark_id'], hash=b['hash'], folder_id=folder_id)
+		self.known_bookmarks.add(b, folder_id)
+
+	def _will_list(self, b, folder_id):
+		"""Check if bookmarks/list may still return a bookmark
+
+		It won't return bookmarks whose id:hash is on the 'have' list
+		of the folder.
+		"""
+		e = self.known_bookmarks.find(bookmark_id=b.get('bookmark_id'))
+		return e is None or e.get('hash') != b.get('hash') or e.get('folder_id', 'unread') != folder_id
+
+	def _fetch_folder(self, folder_id, have):
+		"""Generate pages of items returned by bookmarks/list for a folder
+
+		Bookmarks returned on a page are added to the 'have' argument
+		of the next request, so each request returns only bookmarks we
+		haven't seen yet. Pages are generated as they arrive.
+
+		Doesn't touch known_bookmarks, so it can run on another thread.
+		"""
+		seen = set(have.split(','))
+		while True:
+			self.fetch_guard.check()
+			page = self.api.list_bookmarks(have=have, limit=str(self.page_size), folder_id=folder_id)
+			self.count('pages')
+			yield page
+			bookmarks = [b for b in page if b.get('type') == 'bookmark']
+			if not self.paginate or len(bookmarks) < self.page_size:
+				break
+			new = ['%s:%s' % (b['bookmark_id'], b['hash']) for b in bookmarks]
+			new = [i for i in new if i not in seen]
+			if not new:
+				# the server is not honoring 'have'. Don't loop forever
+				with self.fetch_guard:
+					self.warn('bookmarks/list returned only known bookmarks for folder %r' % (folder_id))
+				break
+			seen.update(new)
+			have = ','.join([i for i in [have] + new if i])
+
+	def _pages(self):
+		"""Generate (folder_id, state, page) tuples for all folders"""
+		if self.parallel_folders:
+			fetches = [self._fetch_folder(folder_id, self._have(folder_id)) for folder_id,state in self.FOLDERS]
+			for i,page in dispatch.merge(fetches):
+				folder_id, state = self.FOLDERS[i]
+				yield folder_id, state, page
+		else:
+			for folder_id, state in self.FOLDERS:
+				for page in self._fetch_folder(folder_id, self._have(folder_id)):
+					yield folder_id, state, page
 
 	def get_changes(self):
-		unread = self.api.list_bookmarks(have=self._have('unread'), limit='500', folder_id='unread')
-		for b in unread:
-			dbg('unread item: %r', b)
-			if b.get('type') != 'bookmark':
-				continue
-			yield dict(url=b['url'], state='unread')
-			self._add_known_bookmark(b, 'unread')
-		archived = self.api.list_bookmarks(have=self._have('archive'), limit='500', folder_id='archive')
-		for b in archived:
-			dbg('archive item: %r', b)
-			if b.get('type') != 'bookmark':
-				continue
-			yield dict(url=b['url'], state='archived')
-			self._add_known_bookmark(b, 'archive')
+		with self.fetch_guard:
+			self.expire_commits()
+		for folder_id, state, page in self._pages():
+			for b in page:
+				dbg('%s item: %r', folder_id, b)
+				if b.get('type') != 'bookmark':
+					continue
+				with self.fetch_guard:
+					echo = self.is_echo(b['url'], state)
+					self._add_known_bookmark(b, folder_id)
+				if not echo:
+					yield dict(url=b['url'], state=state)
 
 	def commit_changes(self, changes):
 		folder_map = dict(unread='unread', archived='archive')
-		for c in changes:
+		def add(c):
 			folder = folder_map[c['state']]
-			r = self.api.add_bookmark(url=c['url'], folder_id=folder)
+			try:
+				return c, folder, self.api.add_bookmark(url=c['url'], folder_id=folder)
+			except transport.HttpError, e:
+				if not 400 <= e.code < 500 or e.code in transport.RETRY_STATUS:
+					raise
+				# the bookmark was rejected (e.g. invalid URL). Retrying
+				# won't help, so skip it
+				return c, folder, e
+
+		# use the URL of the bookmark we already know (if any), so an
+		# alias of the URL doesn't create a duplicate bookmark
+		def known_url(c):
+			e = self._find_known_bookmark(c['url'])
+			if e is not None and e['url'] != c['url']:
+				return c.replace(url=e['url'])
+			return c
+		# URLs rejected before will be rejected again. They were already warned about
+		rejected = self.state.get('rejected_urls', {})
+		skipped = [c for c in changes if canonical_url(c['url']) in rejected]
+		if skipped:
+			self.count('skipped_rejected', len(skipped))
+		changes = [known_url(Change(c)) for c in changes if canonical_url(c['url']) not in rejected]
+
+		limiter = None
+		if self.commit_rate:
+			limiter = dispatch.RateLimiter(self.commit_rate)
+		# the responses are processed here, in the same order as the
+		# changes, so known_bookmarks is never touched by the worker threads
+		for c, folder, r in dispatch.imap(add, changes, self.commit_workers, limiter):
+			if isinstance(r, transport.HttpError):
+				self.warn('Instapaper rejected bookmark %r: %s %s' % (c['url'], r, r.body))
+				self.count('failed_adds')
+				self.state.setdefault('rejected_urls', {})[canonical_url(c['url'])] = r.code
+				continue
 			dbg('add_bookmark return value: %r', r)
 			for b in r:
 				if b.get('type') != 'bookmark':
 					continue
 				self._add_known_bookmark(b, folder)
+				# the bookmark is on the 'have' list now, so it can't echo
+				if self._will_list(b, folder):
+					self.remember_commit(b['url'], c['state'])
 
 class PocketMember(SyncMember):
-	def __init__(self, api, state):
+	# item fields kept during the initial fetch
+	ITEM_FIELDS = ('item_id', 'given_url', 'resolved_url', 'status', 'time_updated')
+
+	def __init__(self, api, state, chunk_size=100, chunk_bytes=65536, send_workers=1, send_retries=2,
+	             initial_page_size=1000, initial_workers=4, initial_page_overlap=10):
+		"""Constructor
+
+		Actions are sent in chunks of at most chunk_size actions and
+		chunk_bytes bytes, with up to send_workers requests in flight at
+		the same time. Actions reported as failed by Pocket are sent again
+		up to send_retries times. Failed requests are not sent again: the
+		transport already retried them as far as its RetryPolicy allows.
+
+		On the first synchronization, the whole list is fetched in pages
+		of initial_page_size items, with up to initial_workers requests
+		in flight at the same time. Consecutive pages overlap by
+		initial_page_overlap items, so items deleted during the fetch
+		don't make the following items fall between pages. If
+		initial_page_size is None, it is fetched using a single request.
+		"""
 		self.api = api
+		self.chunk_size = chunk_size
+		self.chunk_bytes = chunk_bytes
+		self.send_workers = send_workers
+		self.send_retries = send_retries
+		self.initial_page_size = initial_page_size
+		self.initial_workers = initial_workers
+		self.initial_page_overlap = initial_page_overlap
 		super(PocketMember, self).__init__(state)
 
 	def cache_item_id(self, url, item_id):
-		self.state.setdefault('url_item_ids', {})[url] = item_id
+		self.state.setdefault('url_item_ids', {})[canonical_url(url)] = item_id
+
+	def _fetch_page(self, offset, rest=None):
+		self.fetch_guard.check()
+		items = self.api.api_get_items(detailType='simple', sort='oldest',
+		                               count=str(self.initial_page_size), offset=str(offset), rest=rest)
+		self.count('pages')
+		return [dict((k, i[k]) for k in self.ITEM_FIELDS if i.has_key(k)) for i in items]
+
+	def _initial_items(self):
+		"""Fetch the whole list, using multiple 'get' requests
+
+		The pages are sorted by time added, so items added during the
+		fetch don't change the offset of the other items. If the first
+		page is full, the next pages are fetched initial_workers at a
+		time.
+
+		Returns (items, since): the items sorted by time_updated, and the
+		time of the first request (as reported by the server, if
+		possible). Items changed after that may have been fetched before
+		the change, so since is where the next synchronization starts.
+		"""
+		size = self.initial_page_size
+		step = size - min(self.initial_page_overlap, size // 2)
+		items = {}
+		rest = {}
+		start = int(time.time())
+		pages = [self._fetch_page(0, rest)]
+		offset = step
+		while True:
+			known = len(items)
+			for page in pages:
+				for i in page:
+					items[i['item_id']] = i
+			if any(len(page) < size for page in pages):
+				break
+			if len(items) == known:
+				# the server is not honoring 'count' and 'offset'. Don't loop forever
+				with self.fetch_guard:
+					self.warn("'get' returned only known items at offset %d" % (offset - len(pages) * step))
+				break
+			offsets = [offset + n * step for n in range(self.initial_workers)]
+			offset += self.initial_workers * step
+			pages = list(dispatch.imap(self._fetch_page, offsets, self.initial_workers))
+		since = int(rest.get('since') or start)
+		return sorted(items.values(), key=lambda i: int(i['time_updated'])), since
 
 	def get_changes(self):
 		states = {'0':'unread', '1':'archived'}
-		args = dict(detailType='simple')
 		last_update = 0
+		since = None
+		with self.fetch_guard:
+			self.expire_commits()
 		if self.state.has_key('last_update_timestamp'):
 			last_update = int(self.state['last_update_timestamp'])
-			args['since'] = str(last_update)
-		items = self.api.api_get(**args)
-		#dbg('items returned: %r', items)
-		for i in items['list'].values():
+			items = self.api.api_get_items(detailType='simple', since=str(last_update))
+		elif self.initial_page_size:
+			# the cursor is saved only after all pages are fetched
+			items, since = self._initial_items()
+		else:
+			items = self.api.api_get_items(detailType='simple')
+		for i in items:
 			dbg('item: %r', i)
-			if i.has_key('resolved_url'):
-				url = i['resolved_url']
-			else:
-				url = i['given_url']
-			c = dict(url=url)
 			state = states.get(str(i['status']))
-			if state is None:
-				continue
-			c['state'] = state
+			with self.fetch_guard:
+				if i.has_key('resolved_url'):
+					url = i['resolved_url']
+					if i.get('given_url'):
+						self.url_index.add_alias(i['given_url'], url)
+				else:
+					url = i['given_url']
+				if state is None:
+					continue
+				self.cache_item_id(url, i['item_id'])
+				# both URLs are checked, so no remembered commit is left behind
+				echoes = [self.is_echo(u, state) for u in (url, i.get('given_url'))]
+			if not any(echoes):
+				yield dict(url=url, state=state)
 			updated = int(i['time_updated'])
-			self.cache_item_id(url, i['item_id'])
-			yield c
 			if updated > last_update:
 				last_update = updated
-		self.state['last_update_timestamp'] = last_update
+		if since is not None:
+			last_update = since
+		with self.fetch_guard:
+			self.state['last_update_timestamp'] = last_update
+
+	def sync_cursor(self):
+		return self.state.get('last_update_timestamp')
 
 	def find_item_id(self, url):
 		"""Find the item ID for a specific URL
 
-		Necessary to allow an item to be archived.
+		Necessary to allow an item to be archived. Known aliases of
+		the URL are looked up too.
 		"""
-		return self.state.get('url_item_ids', {}).get(url)
+		item_ids = self.state.get('url_item_ids', {})
+		item_id = item_ids.get(url) or item_ids.get(canonical_url(url))
+		if item_id is None:
+			for alias in self.url_index.aliases(url):
+				item_id = item_ids.get(alias)
+				if item_id is not None:
+					break
+		return item_id
 
 	def commit_changes(self, changes):
 		actions = []
@@ -152,23 +588,114 @@ class PocketMember(SyncMember):
 				a = dict(action='archive', item_id=item_id)
 			else:
 				continue
-			actions.append(a)
-		self.api.send_actions(actions)
+			actions.append((c['url'], a))
+		for url,a in self.send_actions(actions):
+			self.remember_commit(url, a['action'] == 'archive' and 'archived' or 'unread')
+
+	def _chunks(self, actions):
+		"""Split list of (url, action) pairs in chunks"""
+		chunk = []
+		size = 0
+		for url,a in actions:
+			n = len(json.dumps(a))
+			if chunk and (len(chunk) >= self.chunk_size or size + n > self.chunk_bytes):
+				yield chunk
+				chunk = []
+				size = 0
+			chunk.append((url, a))
+			size += n
+		if chunk:
+			yield chunk
+
+	def _send_chunk(self, chunk):
+		"""Send a chunk of (url, action) pairs
+
+		Returns a (chunk, action_results) tuple. action_results is None
+		if the whole request failed.
+		"""
+		try:
+			r = self.api.send_actions([a for url,a in chunk])
+		except (transport.HttpError, EnvironmentError), e:
+			warn('Error sending %d actions: %s', len(chunk), e)
+			return chunk, None
+		dbg('send_actions return value: %r', r)
+		return chunk, (r or {}).get('action_results', [True] * len(chunk))
+
+	def send_actions(self, actions):
+		"""Send list of (url, action) pairs
+
+		The actions are sent in chunks, and only the actions that failed
+		are retried. Returns the list of (url, action) pairs that
+		succeeded.
+		"""
+		succeeded = []
+		lost = []
+		for attempt in range(self.send_retries + 1):
+			failed = []
+			for chunk,results in dispatch.imap(self._send_chunk, self._chunks(actions), self.send_workers):
+				if results is None:
+					lost.extend(chunk)
+					continue
+				for (url,a),res in zip(chunk, results):
+					if not res:
+						failed.append((url, a))
+						continue
+					succeeded.append((url, a))
+					if isinstance(res, dict) and res.has_key('item_id'):
+						self.cache_item_id(url, res['item_id'])
+			if not failed:
+				break
+			dbg('%d actions failed on attempt %d', len(failed), attempt)
+			self.count('failed_actions', len(failed))
+			actions = failed
+		for url,a in lost + failed:
+			self.warn('Pocket action failed: %r' % (a))
+		return succeeded
+
+# fields solve_conflict() knows how to handle
+SOLVABLE_FIELDS = frozenset(['url', 'state'])
+
+class FetchTimeout(Exception):
+	pass
 
 class SyncEngine:
-	def __init__(self, state, members):
+	def __init__(self, state, members, parallel=False, fetch_timeout=None, journal=None, observer=None):
+		"""Constructor
+
+		If parallel is True, changes are collected from (and committed
+		to) all members at the same time. fetch_timeout is the maximum time in seconds each
+		member may take (a single value, or a list with one value per
+		member), and is only used on parallel mode. When it runs out,
+		the fetches still running are abandoned: they don't touch the
+		member states anymore.
+
+		If a journal (a journal.CommitJournal object) is provided, changes
+		are committed in chunks and each chunk is recorded on the journal,
+		so an interrupted commit can be finished by resume_sync().
+
+		observer is a stats.SyncObserver object that will get events
+		from the engine and from the members.
+		"""
 		self.state = state
 		self.members = members
+		self.parallel = parallel
+		self.fetch_timeout = fetch_timeout
+		self.journal = journal
+		self.observer = observer or SyncObserver()
+		self.url_index = urls.UrlIndex(state)
+		for m in members:
+			m.observer = self.observer
+			m.url_index = self.url_index
 
 	def solve_conflict(self, changes):
 		urls = set()
 		states = set()
 		for mid,c in changes:
-			urls.add(c['url'])
-			states.add(c['state'])
-			if set(c.keys()) - set(['url', 'state']):
+			if any(k not in SOLVABLE_FIELDS for k in c):
 				# I don't know how to solve conflicts for anything except the 'state' field
 				return None
+			urls.add(c['url'])
+			states.add(c['state'])
 		if len(urls) > 1:
 			# to solve conflicts, the URLs should really match
 			return None
@@ -177,13 +704,13 @@ class SyncEngine:
 		if len(states) == 1:
 			state, = states
 			# this one is obvious: only one state
-			return dict(url=url, state=state)
+			return Change(url=url, state=state)
 
 		# archived items can be unarchived, it won't hurt too much
-		states.remove('archived')
+		states.discard('archived')
 		if len(states) == 1:
 			state, = states
-			return dict(url=url, state=state)
+			return Change(url=url, state=state)
 
 		# anything else, I don't know how to solve
 		return None
@@ -191,10 +718,14 @@ class SyncEngine:
 
 	@staticmethod
 	def different_versions(changes):
+		"""Return the distinct changes from a list, keeping their order"""
+		seen = set()
 		r = []
 		for c in changes:
-			found = any(v==c for v in r)
-			if not found:
+			if not isinstance(c, Change):
+				c = Change(c)
+			if c not in seen:
+				seen.add(c)
 				r.append(c)
 		return r
 
@@ -202,29 +733,29 @@ class SyncEngine:
 		"""Return list of member IDs (indexes on self.members)"""
 		return range(len(self.members))
 
+	def cursors(self):
+		"""Return the sync_cursor() of each member"""
+		return [m.sync_cursor() for m in self.members]
+
+	def member_name(self, mid):
+		return self.members[mid].__class__.__name__
+
 	def warn(self, msg):
 		self.state.setdefault('warnings', []).append(msg)
-		warn(message)
+		warn(msg)
 
 	def check_for_conflicts(self, url, changes):
 		"""Check for conflicts
 
 		If returning None, the changes will be kept as-is.
-		If returning a list, the changes will be skipped, and replaced
-		by the ones in the list.
+		If returning a list of (change, skip_members) pairs, the changes
+		will be skipped, and replaced by the ones in the list. Each
+		replacement change won't be sent to the member IDs in the
+		skip_members set.
 		"""
 		if len(changes) <= 1:
 			return # no conflicts. good!
 
-		def change_skip_member(c, mid):
-			"""Make a change be skipped on a specific member"""
-			c.setdefault('engine_hints', {}).setdefault('skip_members', []).append(mid)
-	
-		def skip_member(mid):
-			# ask for a member to be skipped for all changes
-			for _,c in changes:
-				c.setdefault('engine_hints', {}).setdefault('skip_members', []).append(mid)
-
 		different_versions = self.different_versions([c for mid,c in changes])
 
 		if len(different_versions) == 1:
@@ -232,65 +763,214 @@ class SyncEngine:
 			# make only one change object, and make it skip the members that
 			# already agree
 			c = different_versions[0]
-			for mid,_ in changes:
-				change_skip_member(c, mid)
-			return [c]
+			return [(c, set(mid for mid,_ in changes))]
 		else:
-			conflict_solution = copy.deepcopy(self.solve_conflict(changes))
+			conflict_solution = self.solve_conflict(changes)
 			if conflict_solution is None:
 				self.warn("I don't know how to solve the conflict for URL: %s" % (url))
 				return [] # won't send anything anywhere
-			for mid,c in changes:
-				if c == conflict_solution:
-					# this member already agrees with the conflict solution, skip it
-					change_skip_member(conflict_solution, mid)
-			return [conflict_solution]
+			# skip the members that already agree with the conflict solution
+			skip = set(mid for mid,c in changes if c == conflict_solution)
+			return [(conflict_solution, skip)]
+
+	def _fetch_timeout(self, mid):
+		if isinstance(self.fetch_timeout, (list, tuple)):
+			return self.fetch_timeout[mid]
+		return self.fetch_timeout
+
+	def collect_changes(self):
+		"""Get the list of changes from each member"""
+		def collect(m):
+			start = time.time()
+			r = [Change(c) for c in m.get_changes()]
+			self.observer.phase_finished('fetch', time.time() - start, len(r), m.__class__.__name__)
+			return r
+
+		if not self.parallel:
+			return [collect(m) for m in self.members]
+
+		results = [None for m in self.members]
+		errors = [None for m in self.members]
+		def run(mid, m):
+			try:
+				results[mid] = collect(m)
+			except:
+				errors[mid] = sys.exc_info()
+
+		threads = []
+		for mid,m in enumerate(self.members):
+			m.fetch_guard = FetchGuard()
+			t = threading.Thread(target=run, args=(mid, m))
+			t.daemon = True
+			t.start()
+			threads.append(t)
+		start = time.time()
+		for mid,t in enumerate(threads):
+			timeout = self._fetch_timeout(mid)
+			if timeout is None:
+				t.join()
+			else:
+				t.join(max(0, start + timeout - time.time()))
+			if t.is_alive():
+				# the threads can't be killed. Make sure they don't touch
+				# the state anymore
+				for m in self.members:
+					m.fetch_guard.cancel()
+				raise FetchTimeout('Timeout getting changes from %r' % (self.members[mid]))
+		for e in errors:
+			if e is not None:
+				raise e[0], e[1], e[2]
+		return results
 
 	def calculate_sync(self):
 		"""Calculate the changes necessary to run a synchronization run
 
 		Generates (member, changes) tuples. The results are used by the
 		synchronize() method to actually commit the changes.
+
+		The same Change object may appear on the list of changes of
+		multiple members.
 		"""
-		changesets = []
-		mids = range(len(self.members))
-		changesets = [list(m.get_changes()) for m in self.members]
+		mids = self.member_ids()
+		changesets = self.collect_changes()
 		extra_changes = []
+		replaced = set() # (mid, index) of the changes replaced by extra_changes
 
 		# look for conflicts
+		start = time.time()
 		per_url = {}
 		for mid,changes in enumerate(changesets):
-			for c in changes:
-				per_url.setdefault(c['url'], []).append( (mid, c) )
+			for i,c in enumerate(changes):
+				per_url.setdefault(self.url_index.key(c['url']), []).append( (mid, i, c) )
 		for url,changes in per_url.items():
-			r = self.check_for_conflicts(url, changes)
+			group = [(mid, c) for mid,i,c in changes]
+			if len(set(c['url'] for mid,c in group)) > 1:
+				# different URLs for the same item. Use the same URL on all
+				# changes, so they can be compared
+				first = group[0][1]['url']
+				group = [(mid, c.replace(url=first)) for mid,c in group]
+			r = self.check_for_conflicts(url, group)
 			if r is not None: # changes will be replaced
-				for mid,c in changes:
-					c.clear() # remove item by clearing it
+				replaced.update((mid, i) for mid,i,c in changes)
 				extra_changes.extend(r)
+		self.observer.phase_finished('conflicts', time.time() - start, len(replaced))
 
+		start = time.time()
 		resulting_changes = dict((mid,[]) for mid in mids)
-		for sourceid,changes in list(enumerate(changesets))+[(-1, extra_changes)]:
-			for c in changes:
-				if len(c) == 0:
+		for sourceid,changes in enumerate(changesets):
+			for i,c in enumerate(changes):
+				if (sourceid, i) in replaced:
 					continue
-				for destid,dm in enumerate(self.members):
-					if sourceid == destid:
-						continue
-					cc = copy.deepcopy(c)
-					engine_hints = cc.get('engine_hints', {})
-					if cc.has_key('engine_hints'):
-						del cc['engine_hints']
-					if destid in engine_hints.get('skip_members', []):
-						continue # skip this change
-					resulting_changes[destid].append(cc)
+				for destid in mids:
+					if destid != sourceid:
+						resulting_changes[destid].append(c)
+		for c,skip_members in extra_changes:
+			for destid in mids:
+				if destid not in skip_members:
+					resulting_changes[destid].append(c)
+		self.observer.phase_finished('fanout', time.time() - start,
+		                             sum(len(changes) for changes in resulting_changes.values()))
 
 		for mid,member in enumerate(self.members):
 			yield member, resulting_changes[mid]
 
+	def _commit_chunk(self, member, changes, start):
+		"""Commit one chunk of changes to a member, returning the time it took"""
+		t = time.time()
+		member.commit_changes(changes[start:start + self.journal.chunk_size])
+		return time.time() - t
+
+	def _commit_chunks(self, commits):
+		"""Commit a list of (mid, member, changes, done) tuples in chunks
+
+		Each chunk is recorded on the journal (which saves the state)
+		after it is committed. The (mid, start) chunks in done are
+		skipped. On parallel mode, the next chunk of every member is
+		committed at the same time, and the journal is updated between
+		these rounds, when no member is changing its state; a member
+		that fails stops there, the others run until the end, and the
+		first exception is re-raised.
+		"""
+		size = self.journal.chunk_size
+		queues = [(mid, member, changes, [start for start in range(0, len(changes), size) if (mid, start) not in done])
+		          for mid,member,changes,done in commits]
+		durations = dict((mid, 0.0) for mid,member,changes,done in commits)
+		def record(mid, changes, start, duration):
+			durations[mid] += duration
+			self.journal.record(mid, start, min(start + size, len(changes)))
+
+		error = None
+		if not self.parallel:
+			for mid,member,changes,starts in queues:
+				for start in starts:
+					record(mid, changes, start, self._commit_chunk(member, changes, start))
+		else:
+			def commit((mid, member, changes, start)):
+				try:
+					return self._commit_chunk(member, changes, start), None
+				except:
+					return None, sys.exc_info()
+			active = [q for q in queues if q[3]]
+			while active:
+				chunks = [(mid, member, changes, starts.pop(0)) for mid,member,changes,starts in active]
+				failed = set()
+				for (mid, member, changes, start),(duration, exc) in zip(chunks, dispatch.run_all(commit, chunks, len(chunks))):
+					if exc is not None:
+						failed.add(mid)
+						error = error or exc
+						continue
+					record(mid, changes, start, duration)
+				active = [q for q in active if q[3] and q[0] not in failed]
+			if error is not None:
+				raise error[0], error[1], error[2]
+		for mid,member,changes,done in commits:
+			self.observer.phase_finished('commit', durations[mid], len(changes), self.member_name(mid))
+
+	def _commit_member(self, mid, member, changes):
+		start = time.time()
+		member.commit_changes(changes)
+		self.observer.phase_finished('commit', time.time() - start, len(changes), self.member_name(mid))
+
+	def _commit_members(self, commits, journal=True):
+		"""Commit a list of (mid, member, changes, done) tuples
+
+		On parallel mode, the members are committed at the same time,
+		and all of them run until the end even if one fails. The changes
+		are committed in chunks if there's a journal, unless journal is False.
+		"""
+		if journal and self.journal is not None:
+			self._commit_chunks(commits)
+			return
+		workers = self.parallel and len(commits) or 1
+		dispatch.run_all(lambda (mid, member, changes, done): self._commit_member(mid, member, changes),
+		                 commits, workers)
+
 	def commit_sync(self, sync_result):
-		for member, changes in sync_result:
-			member.commit_changes(changes)
+		sync_result = list(sync_result)
+		commits = [(mid, member, changes, ()) for mid,(member, changes) in enumerate(sync_result)]
+		if self.journal is None or not any(changes for member,changes in sync_result):
+			# nothing to journal (or to save) if there's nothing to commit
+			self._commit_members(commits, journal=False)
+			return
+		self.journal.begin([changes for member,changes in sync_result])
+		self._commit_members(commits)
+		self.journal.finish()
+
+	def resume_sync(self):
+		"""Finish a commit interrupted in the middle
+
+		The state saved by the journal must be loaded before the members
+		are created. Returns False if there was nothing to resume.
+		"""
+		pending = self.journal and self.journal.pending()
+		if not pending:
+			return False
+		plan, done = pending
+		info('Resuming interrupted commit (%d chunks already done)', len(done))
+		self._commit_members([(mid, member, [Change(c) for c in changes], done)
+		                      for mid,(member, changes) in enumerate(zip(self.members, plan))])
+		self.journal.finish()
+		return True
 
 	def synchronize(self):
 		r = self.calculate_sync()
@@ -1,7 +1,7 @@
 import unittest
-from syncitlater.tests import instapaper_sync, pocket_sync, sync_algorithm
+from syncitlater.tests import instapaper_sync, pocket_sync, sync_algorithm, json_stream, state_store, api_http, url_index, record_replay, sync_plan, simple_daemon, batch_sync
 
-MODS = [instapaper_sync, pocket_sync, sync_algorithm]
+MODS = [instapaper_sync, pocket_sync, sync_algorithm, json_stream, state_store, api_http, url_index, record_replay, sync_plan, simple_daemon, batch_sync]
 
 def tests_from_mod(loader, m):
     lt = getattr(m, 'load_tests', None)
@@ -0,0 +1,249 @@
+from syncitlater import sync, pocket, instapaper, transport, dispatch
+from syncitlater.tests.mockservers import MockPocketServer, MockInstapaperServer
+import unittest
+import time
+import socket, ssl, httplib
+
+class PocketHttpTest(unittest.TestCase):
+	def setUp(self):
+		self.server = MockPocketServer()
+		self.server.start()
+		self.transport = transport.HttpTransport()
+		self.state = {}
+		self.api = pocket.PocketApi('pocket-key', self.state, transport=self.transport,
+		                            api_base=self.server.api_base)
+
+	def tearDown(self):
+		self.transport.close()
+		self.server.stop()
+
+	def authenticate(self):
+		self.api.start_auth('http://example.com/')
+		self.api.auth_finished()
+
+	def testAuth(self):
+		self.assertFalse(self.api.test_auth())
+		self.authenticate()
+		self.assertTrue(self.api.test_auth())
+		self.state['access_token'] = 'wrong'
+		self.assertFalse(self.api.test_auth())
+
+	def testAuthCache(self):
+		self.authenticate()
+		self.assertTrue(self.api.test_auth(max_age=60))
+		n = len(self.server.requests)
+		self.assertTrue(self.api.test_auth(max_age=60))
+		self.assertEquals(len(self.server.requests), n)
+		self.assertTrue(self.api.test_auth())
+		self.assertEquals(len(self.server.requests), n + 1)
+		# a rejected request discards the verification
+		self.state['access_token'] = 'wrong'
+		self.state['auth_verified']['token'] = 'wrong'
+		self.assertRaises(transport.PleaseReauthenticate, self.api.api_get)
+		self.assertFalse(self.api.test_auth(max_age=60))
+
+	def testSyncMember(self):
+		self.authenticate()
+		self.server.add_library(2000)
+		member = sync.PocketMember(self.api, {}, chunk_size=50, send_workers=2)
+		changes = list(member.get_changes())
+		self.assertEquals(len(changes), 2000)
+		self.assertEquals(list(member.get_changes()), [])
+
+		member.commit_changes([dict(url='http://new.example.com/%d' % (i), state='unread') for i in range(120)])
+		self.assertEquals(len([p for p,b in self.server.requests if p.endswith('/send')]), 3)
+		self.assertEquals(len(self.server.items), 2120)
+		# chunks are sent concurrently, so the item IDs may be assigned in any order
+		item_ids = dict((i['given_url'], item_id) for item_id,i in self.server.items.items())
+		self.assertEquals(member.find_item_id('http://new.example.com/0'), item_ids['http://new.example.com/0'])
+
+	def testInitialPages(self):
+		self.authenticate()
+		self.server.add_library(2000)
+		state = {}
+		member = sync.PocketMember(self.api, state, initial_page_size=300, initial_workers=3)
+		self.transport.retry.max_retries = 0
+		self.server.errors.extend([None] * 4 + [503])
+		self.assertRaises(transport.HttpError, list, member.get_changes())
+		self.assertFalse(state.has_key('last_update_timestamp'))
+
+		del self.server.requests[:]
+		changes = list(member.get_changes())
+		self.assertEquals(len(changes), 2000)
+		self.assertEquals(len(set(c['url'] for c in changes)), 2000)
+		# first page alone, then two rounds of 3 pages
+		self.assertEquals(len(self.server.requests), 7)
+		self.assertEquals(state['last_update_timestamp'], self.server.now)
+		self.assertEquals(list(member.get_changes()), [])
+
+	def testInjectedError(self):
+		self.authenticate()
+		self.transport.retry.max_retries = 0
+		self.server.errors.append(503)
+		self.assertRaises(transport.HttpError, self.api.api_get)
+		self.assertEquals(self.api.api_get()['status'], 1)
+
+	def testRetry(self):
+		self.authenticate()
+		self.transport.retry = transport.RetryPolicy(base_delay=0.01)
+		self.server.errors.extend([503, 502, 429])
+		self.assertEquals(self.api.api_get()['status'], 1)
+		self.server.errors.extend([503] * 5)
+		self.assertRaises(transport.HttpError, self.api.api_get)
+
+	def testRetryAfter(self):
+		self.authenticate()
+		self.server.retry_after = 0.2
+		self.server.errors.append(429)
+		start = time.time()
+		self.assertEquals(self.api.api_get()['status'], 1)
+		self.assertTrue(time.time() - start >= 0.2)
+		# don't wait if the server asks for too long
+		self.server.retry_after = 3600
+		self.server.errors.append(429)
+		self.assertRaises(transport.HttpError, self.api.api_get)
+
+	def testRetryBudget(self):
+		self.authenticate()
+		self.transport.retry = transport.RetryPolicy(base_delay=0.01, budget=3)
+		self.server.errors.extend([503] * 5)
+		self.assertRaises(transport.HttpError, self.api.api_get)
+		self.assertEquals(self.server.errors, [503])
+		# the budget is empty. Errors are not retried anymore
+		self.assertRaises(transport.HttpError, self.api.api_get)
+		self.assertEquals(self.api.api_get()['status'], 1)
+
+	def testDroppedResponse(self):
+		self.authenticate()
+		self.transport.retry = transport.RetryPolicy(base_delay=0.01)
+		self.server.errors.append('drop')
+		self.assertEquals(self.api.api_get()['status'], 1)
+		# the server may have processed it already. Don't send it again
+		self.server.errors.append('drop')
+		self.assertRaises(httplib.HTTPException, self.api.send_actions, [dict(action='add', url='http://1.example.com/')])
+		self.assertEquals(len(self.server.items), 1)
+
+	def testConnectError(self):
+		self.authenticate()
+		self.transport.close()
+		self.transport.retry = transport.RetryPolicy(base_delay=0.01)
+		s = socket.socket()
+		s.bind(('127.0.0.1', 0))
+		closed_port = s.getsockname()[1]
+		s.close()
+		connect = self.transport._connect
+		refused = []
+		def _connect(key):
+			conn = connect(key)
+			if not refused:
+				refused.append(conn)
+				conn.port = closed_port
+			return conn
+		self.transport._connect = _connect
+		# the request was never sent, so it can be sent again
+		self.api.send_actions([dict(action='add', url='http://1.example.com/')])
+		self.assertEquals(len(refused), 1)
+		self.assertEquals(len(self.server.items), 1)
+
+	def testSslErrorNotRetried(self):
+		self.authenticate()
+		self.transport.close()
+		self.transport.retry = transport.RetryPolicy(base_delay=0.01)
+		attempts = []
+		class BadCertConnection(httplib.HTTPConnection):
+			def connect(self):
+				attempts.append(self)
+				raise ssl.SSLError(1, 'certificate verify failed')
+		self.transport._connect = lambda key: BadCertConnection(key[1], key[2])
+		self.assertRaises(ssl.SSLError, self.api.api_get)
+		self.assertEquals(len(attempts), 1)
+
+	def testRateLimit(self):
+		self.authenticate()
+		self.transport.host_limiters['127.0.0.1'] = dispatch.RateLimiter(100)
+		start = time.time()
+		for i in range(10):
+			self.api.api_get(count=0)
+		self.assertTrue(time.time() - start >= 0.09)
+
+
+class RetryAfterTest(unittest.TestCase):
+	def testHeaders(self):
+		self.assertEquals(transport.retry_after({}), None)
+		self.assertEquals(transport.retry_after({'retry-after': '30'}), 30)
+		self.assertEquals(transport.retry_after({'retry-after': 'Thu, 01 Jan 2015 00:01:00 GMT'}, now=1420070400), 60)
+		self.assertEquals(transport.retry_after({'x-limit-user-remaining': '10', 'x-limit-user-reset': '300'}), None)
+		self.assertEquals(transport.retry_after({'x-limit-user-remaining': '0', 'x-limit-user-reset': '300'}), 300)
+		self.assertEquals(transport.retry_after({'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '1420070410'},
+		                                        now=1420070400), 10)
+
+
+class InstapaperHttpTest(unittest.TestCase):
+	def setUp(self):
+		self.server = MockInstapaperServer()
+		self.server.start()
+		self.transport = transport.HttpTransport()
+		self.state = {}
+		self.api = instapaper.InstapaperApi('instapaper-key', 'instapaper-secret', self.state,
+		                                    transport=self.transport, api_base=self.server.api_base)
+
+	def tearDown(self):
+		self.transport.close()
+		self.server.stop()
+
+	def testAuth(self):
+		self.assertFalse(self.api.test_auth())
+		self.api.authenticate('instapaperuser', 'secret')
+		self.assertTrue(self.api.test_auth())
+
+	def testAuthCache(self):
+		self.api.authenticate('instapaperuser', 'secret')
+		self.assertTrue(self.api.test_auth(max_age=60))
+		n = len(self.server.requests)
+		self.assertTrue(self.api.test_auth(max_age=60))
+		self.assertEquals(len(self.server.requests), n)
+		# verification of another token doesn't count
+		self.state['oauth_token'] = 'other'
+		self.assertFalse(self.api.test_auth(max_age=60))
+
+	def testBadSignature(self):
+		self.api = instapaper.InstapaperApi('instapaper-key', 'wrong-secret', self.state,
+		                                    transport=self.transport, api_base=self.server.api_base)
+		self.state.update(oauth_token='instapaper-token', oauth_token_secret='instapaper-token-secret')
+		self.assertFalse(self.api.test_auth())
+
+	def testSyncMember(self):
+		self.api.authenticate('instapaperuser', 'secret')
+		self.server.add_library(1200)
+		member = sync.InstapaperMember(self.api, {}, commit_workers=4)
+		changes = list(member.get_changes())
+		self.assertEquals(len(changes), 1200)
+		self.assertEquals(list(member.get_changes()), [])
+
+		member.commit_changes([dict(url='http://new.example.com/%d' % (i), state='archived') for i in range(20)])
+		self.assertEquals(len(self.server.folders['archive']), len([c for c in changes if c['state'] == 'archived']) + 20)
+		self.assertEquals(list(member.get_changes()), [])
+
+	def testInvalidUrl(self):
+		self.api.authenticate('instapaperuser', 'secret')
+		state = {}
+		member = sync.InstapaperMember(self.api, state, commit_workers=2)
+		member.commit_changes([dict(url='http://1.example.com/', state='unread'),
+		                       dict(url='javascript:void(0)', state='unread'),
+		                       dict(url='http://2.example.com/', state='archived')])
+		self.assertEquals([b['url'] for b in self.server.folders['unread']], ['http://1.example.com/'])
+		self.assertEquals([b['url'] for b in self.server.folders['archive']], ['http://2.example.com/'])
+		self.assertEquals(len(state['warnings']), 1)
+		# the rejected URL is not sent (nor warned about) again
+		n = len(self.server.requests)
+		member.commit_changes([dict(url='javascript:void(0)', state='archived')])
+		self.assertEquals(len(self.server.requests), n)
+		self.assertEquals(len(state['warnings']), 1)
+
+	def testErrorStatus(self):
+		self.api.authenticate('instapaperuser', 'secret')
+		self.transport.retry.max_retries = 0
+		self.server.errors.append(503)
+		self.assertRaises(transport.HttpError, self.api.list_bookmarks)
+		self.state['oauth_token'] = 'wrong'
+		self.assertRaises(transport.PleaseReauthenticate, self.api.list_bookmarks)
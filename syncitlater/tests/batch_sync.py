@@ -0,0 +1,136 @@
+import sys, types
+try:
+	from syncitlater import settings
+except ImportError:
+	# simple_tool only needs the API keys from the user's settings
+	sys.modules['syncitlater.settings'] = types.ModuleType('syncitlater.settings')
+from syncitlater import batch, simple_tool, pocket, instapaper, statestore
+from syncitlater.tests.mockservers import MockPocketServer, MockInstapaperServer
+import unittest
+import os, shutil, tempfile
+import time
+import json, argparse
+import logging
+
+settings = simple_tool.settings
+
+API_KEYS = dict(POCKET_API_KEY='pocket-key', INSTAPAPER_API_KEY='instapaper-key',
+                INSTAPAPER_API_SECRET='instapaper-secret')
+
+class MockAccountTest(unittest.TestCase):
+	"""Base class for tests running simple_tool code against the mock servers"""
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.pocket = MockPocketServer(consumer_key=API_KEYS['POCKET_API_KEY'])
+		self.instapaper = MockInstapaperServer(consumer_key=API_KEYS['INSTAPAPER_API_KEY'],
+		                                       consumer_secret=API_KEYS['INSTAPAPER_API_SECRET'])
+		self.pocket.start()
+		self.instapaper.start()
+		self.saved = dict((k, getattr(settings, k, None)) for k in API_KEYS)
+		for k,v in API_KEYS.items():
+			setattr(settings, k, v)
+		self.api_bases = pocket.API_BASE, instapaper.API_BASE
+		pocket.API_BASE = self.pocket.api_base
+		instapaper.API_BASE = self.instapaper.api_base
+		# the failed accounts are logged by the root logger
+		self.handler = logging.NullHandler()
+		logging.getLogger().addHandler(self.handler)
+
+	def tearDown(self):
+		logging.getLogger().removeHandler(self.handler)
+		pocket.API_BASE, instapaper.API_BASE = self.api_bases
+		for k,v in self.saved.items():
+			if v is None:
+				delattr(settings, k)
+			else:
+				setattr(settings, k, v)
+		self.pocket.stop()
+		self.instapaper.stop()
+		shutil.rmtree(self.dir)
+
+	def args(self, **kwargs):
+		args = argparse.Namespace(workers=2, rate=None, pocket_rate=None, instapaper_rate=None, auth_ttl=86400,
+		                          parallel=False, fetch_timeout=None, dry_run=True, interactive=False)
+		args.__dict__.update(kwargs)
+		return args
+
+	def credentials(self):
+		return dict(api_states=[dict(access_token=self.pocket.access_token, username=self.pocket.username),
+		                        dict(oauth_token=self.instapaper.token.key,
+		                             oauth_token_secret=self.instapaper.token.secret)])
+
+
+class BatchTest(MockAccountTest):
+	def write_manifest(self, accounts):
+		path = os.path.join(self.dir, 'manifest.json')
+		json.dump(dict(accounts=accounts), open(path, 'w'))
+		return batch.load_manifest(path)
+
+	def testLoadManifest(self):
+		accounts = self.write_manifest([dict(name='alice', state='a/alice.json'),
+		                                dict(name='bob', state_db='bob.db'),
+		                                dict(name='carol')])
+		self.assertEquals(accounts, [dict(name='alice', state=os.path.join(self.dir, 'a/alice.json')),
+		                             dict(name='bob', state_db=os.path.join(self.dir, 'bob.db')),
+		                             dict(name='carol', state=os.path.join(self.dir, 'carol.json'))])
+		self.assertRaises(ValueError, self.write_manifest, [dict(name='alice'), dict(name='alice')])
+
+	def testSyncAccount(self):
+		self.pocket.add_library(5)
+		# archived bookmarks can't be added to Pocket
+		self.instapaper.add_library(3, archived_ratio=0)
+		account, = self.write_manifest([dict(name='alice')])
+		json.dump(self.credentials(), open(account['state'], 'w'))
+		http = batch.make_transport(self.args())
+		try:
+			self.assertEquals(batch.sync_account(account, self.args(dry_run=False), http), ('alice', 8, None))
+		finally:
+			http.close()
+		self.assertEquals(len(self.pocket.items), 8)
+		self.assertEquals(sum(len(f) for f in self.instapaper.folders.values()), 8)
+		state = json.load(open(account['state']))
+		self.assertTrue(state['member_states'][0].has_key('last_update_timestamp'))
+		self.assertEquals(len(state['member_states'][1]['known_bookmarks']), 8)
+
+	def testRunBatch(self):
+		self.pocket.add_library(5)
+		self.instapaper.add_library(3, archived_ratio=0)
+		accounts = self.write_manifest([dict(name='alice'), dict(name='bob', state_db='bob.db'),
+		                                dict(name='carol'), dict(name='dave')])
+		json.dump(self.credentials(), open(accounts[0]['state'], 'w'))
+		store = statestore.SqliteStateStore(accounts[1]['state_db'])
+		store.save(self.credentials())
+		store.close()
+		# carol was never authenticated, and dave's state is broken
+		open(accounts[3]['state'], 'w').write('{')
+		results = batch.run_batch(accounts, self.args(workers=1, dry_run=False))
+		self.assertEquals([(name, error is None) for name,count,error in results],
+		                  [('alice', True), ('bob', True), ('carol', False), ('dave', False)])
+		self.assertEquals(results[0][1], 8)
+		self.assertEquals(results[2][2], 'authentication failed')
+
+		# each account has its own state
+		alice = json.load(open(accounts[0]['state']))
+		store = statestore.SqliteStateStore(accounts[1]['state_db'])
+		bob = store.load()
+		store.close()
+		for state in (alice, bob):
+			self.assertTrue(state['member_states'][0].has_key('last_update_timestamp'))
+			self.assertEquals(len(state['member_states'][1]['known_bookmarks']), 8)
+		self.assertFalse(os.path.exists(accounts[2]['state']))
+		self.assertEquals(open(accounts[3]['state']).read(), '{')
+
+	def testHostLimiter(self):
+		self.pocket.add_library(5)
+		self.instapaper.add_library(5)
+		accounts = self.write_manifest([dict(name=name) for name in ('alice', 'bob', 'carol')])
+		for a in accounts:
+			json.dump(self.credentials(), open(a['state'], 'w'))
+		# both mock servers are on the same host, so its limiter is shared by all requests
+		start = time.time()
+		results = batch.run_batch(accounts, self.args(workers=3, pocket_rate=100))
+		elapsed = time.time() - start
+		self.assertEquals([error for name,count,error in results], [None] * 3)
+		requests = len(self.pocket.requests) + len(self.instapaper.requests)
+		self.assertEquals(requests, 3 * 5)
+		self.assertTrue(elapsed >= (requests - 1) / 100.0)
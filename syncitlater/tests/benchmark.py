@@ -0,0 +1,184 @@
+"""Synthetic benchmark for the sync pipeline
+
+Generates Pocket and Instapaper libraries of different sizes on top of the
+fake API objects used by the tests, and measures the time spent by each
+phase of a synchronization run, plus the peak memory usage.
+
+Usage: python -m syncitlater.tests.benchmark [--sizes 1000,10000,100000] [-o results.json]
+"""
+from syncitlater import sync
+from syncitlater.tests.instapaper_sync import FakeInstapaperApi
+from syncitlater.tests.pocket_sync import FakePocketApi
+from syncitlater.tests.sync_algorithm import FakeMember
+import sys, time
+import json
+import random
+import resource
+import platform
+import multiprocessing
+import Queue
+import logging
+
+
+class BenchInstapaperApi(FakeInstapaperApi):
+	"""Fake Instapaper API for big libraries
+
+	To keep the cost of the fake API low, it assumes the 'have' argument
+	lists a prefix of the folder, which is how InstapaperMember pages
+	through a folder on the first synchronization.
+	"""
+	def __init__(self):
+		self.fake_bookmarks = {}
+		self.fake_added_bookmarks = []
+
+	def list_bookmarks(self, folder_id='unread', have='', limit='500', **kwargs):
+		start = have and have.count(',') + 1 or 0
+		return [dict(type='meta')] + self.fake_bookmarks.get(folder_id, [])[start:start + int(limit)]
+
+
+class BenchPocketApi(FakePocketApi):
+	"""Fake Pocket API for big libraries
+
+	To keep the cost of the fake API low, the items are kept on a list
+	sorted by time_updated, so count/offset pages are just slices of it.
+	"""
+	def __init__(self):
+		FakePocketApi.__init__(self)
+		self.fake_items = []
+
+	def api_get_items(self, count=None, offset='0', **kwargs):
+		if count is None:
+			return self.fake_items
+		return self.fake_items[int(offset):int(offset) + int(count)]
+
+
+def generate_libraries(size, overlap, conflicts, seed=0):
+	"""Generate fake Pocket and Instapaper libraries
+
+	Each service gets 'size' items. A fraction 'overlap' of the URLs exists
+	on both services, and a fraction 'conflicts' of those has different
+	states on each side.
+	"""
+	rnd = random.Random(seed)
+	pocketapi = BenchPocketApi()
+	instapaperapi = BenchInstapaperApi()
+	instapaperapi.fake_bookmarks = {'unread': [], 'archive': []}
+	shared = int(size * overlap)
+	for i in range(size):
+		state = rnd.random() < 0.5 and '0' or '1'
+		item_id = str(i)
+		pocketapi.fake_items.append(dict(item_id=item_id, status=state,
+			resolved_url='http://example.com/article/%d' % (i), time_updated=str(1350000000 + i)))
+
+		if i < shared:
+			url = 'http://example.com/article/%d' % (i)
+			if rnd.random() < conflicts:
+				state = state == '0' and '1' or '0'
+		else:
+			url = 'http://example.com/instapaper/%d' % (i)
+		folder = state == '0' and 'unread' or 'archive'
+		instapaperapi.fake_bookmarks[folder].append(dict(type='bookmark', bookmark_id=i,
+			hash='h%d' % (i), url=url))
+	return pocketapi, instapaperapi
+
+
+def peak_rss():
+	"""Peak resident set size of the process, in KB"""
+	r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		r = r / 1024
+	return r
+
+
+def timed(func, *args):
+	start = time.time()
+	r = func(*args)
+	return time.time() - start, r
+
+
+def run_benchmark(size, overlap, conflicts):
+	pocketapi, instapaperapi = generate_libraries(size, overlap, conflicts)
+	members = [('pocket', sync.PocketMember(pocketapi, {})),
+	           ('instapaper', sync.InstapaperMember(instapaperapi, {}))]
+	result = dict(items=size, overlap=overlap, conflicts=conflicts, phases={}, changes={})
+	phases = result['phases']
+	baseline_rss = peak_rss()
+
+	phases['get_changes'] = {}
+	fetched = []
+	for name,m in members:
+		t, changes = timed(lambda: list(m.get_changes()))
+		phases['get_changes'][name] = t
+		fetched.append(changes)
+
+	fakes = [FakeMember() for m in members]
+	for f,changes in zip(fakes, fetched):
+		f.fake_changes = changes
+	engine = sync.SyncEngine({}, fakes)
+	t, sync_result = timed(lambda: list(engine.calculate_sync()))
+	phases['calculate_sync'] = t
+
+	phases['commit_changes'] = {}
+	for (name,m),(fake,changes) in zip(members, sync_result):
+		t, _ = timed(m.commit_changes, changes)
+		phases['commit_changes'][name] = t
+		result['changes'][name] = len(changes)
+
+	result['peak_rss_kb'] = peak_rss()
+	result['baseline_rss_kb'] = baseline_rss
+	return result
+
+
+def _run_child(q, size, overlap, conflicts):
+	q.put(run_benchmark(size, overlap, conflicts))
+
+def run_isolated(size, overlap, conflicts):
+	"""Run benchmark on a separate process, so the peak memory usage of each run is independent
+
+	Raises RuntimeError if the process dies without a result.
+	"""
+	q = multiprocessing.Queue()
+	p = multiprocessing.Process(target=_run_child, args=(q, size, overlap, conflicts))
+	p.start()
+	while True:
+		# checked before waiting, so a result sent right before exiting is not lost
+		alive = p.is_alive()
+		try:
+			r = q.get(timeout=1)
+			break
+		except Queue.Empty:
+			if not alive:
+				p.join()
+				raise RuntimeError('benchmark process for %d items died with exit code %r' % (size, p.exitcode))
+	p.join()
+	return r
+
+
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(description='Sync It Later synthetic benchmark')
+	parser.add_argument('--sizes', default='1000,10000,100000',
+	                    help='comma-separated list of library sizes')
+	parser.add_argument('--overlap', type=float, default=0.5,
+	                    help='fraction of the items existing on both services')
+	parser.add_argument('--conflicts', type=float, default=0.1,
+	                    help='fraction of the shared items with conflicting states')
+	parser.add_argument('-o', '--output', help='file where the JSON results are written')
+	args = parser.parse_args(argv[1:])
+	logging.basicConfig(level=logging.ERROR)
+
+	results = []
+	for size in [int(s) for s in args.sizes.split(',')]:
+		r = run_isolated(size, args.overlap, args.conflicts)
+		sys.stderr.write('%d items: %r\n' % (size, r['phases']))
+		results.append(r)
+
+	report = dict(python=platform.python_version(), timestamp=time.time(), results=results)
+	if args.output:
+		json.dump(report, open(args.output, 'w'), indent=1, sort_keys=True)
+	else:
+		json.dump(report, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
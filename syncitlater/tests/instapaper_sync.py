@@ -143,3 +143,119 @@ class InstapaperSyncTest(unittest.TestCase):
 		self.assertEquals(self.find_known_bookmark('http://1.example.com/')['folder_id'], 'unread')
 		self.assertEquals(self.find_known_bookmark('http://2.example.com/')['folder_id'], 'unread')
 		self.assertEquals(self.find_known_bookmark('http://3.example.com/')['folder_id'], 'archive')
+
+	def testKnownBookmarkMovedFolder(self):
+		self.state['known_bookmarks'] = [
+			dict(url='http://1.example.com/', bookmark_id=1, hash='one', folder_id='unread'),
+			dict(url='http://2.example.com/', bookmark_id=2, hash='two', folder_id='unread')]
+		self.member._add_known_bookmark(dict(url='http://1.example.com/', bookmark_id=1, hash='one2'), 'archive')
+		self.assertEquals(len(self.state['known_bookmarks']), 2)
+		self.assertEquals(self.member._have('unread'), '2:two')
+		self.assertEquals(self.member._have('archive'), '1:one2')
+
+	def testHaveUpdates(self):
+		self.state['known_bookmarks'] = [
+			dict(url='http://1.example.com/', bookmark_id=1, hash='one', folder_id='unread')]
+		self.assertEquals(self.member._have('unread'), '1:one')
+		self.assertEquals(self.member._have('archive'), '')
+		self.member._add_known_bookmark(dict(url='http://2.example.com/', bookmark_id=2, hash='two'), 'unread')
+		self.member._add_known_bookmark(dict(url='http://3.example.com/', bookmark_id=3, hash='three'), 'archive')
+		self.assertEquals(self.member._have('unread'), '1:one,2:two')
+		self.assertEquals(self.member._have('archive'), '3:three')
+		self.member._add_known_bookmark(dict(url='http://1.example.com/', bookmark_id=1, hash='one2'), 'unread')
+		self.assertEquals(self.member._have('unread'), '2:two,1:one2')
+		# replacing the list on the state resets the index
+		self.state['known_bookmarks'] = []
+		self.assertEquals(self.member._have('unread'), '')
+
+	def testKnownBookmarkById(self):
+		self.state['known_bookmarks'] = [
+			dict(url='http://1.example.com/', bookmark_id=1, hash='one', folder_id='unread')]
+		self.member._add_known_bookmark(dict(url='http://1.example.com/?x', bookmark_id=1, hash='one'), 'unread')
+		self.assertEquals(len(self.state['known_bookmarks']), 1)
+		self.assertEquals(self.find_known_bookmark('http://1.example.com/?x')['bookmark_id'], 1)
+		self.assertEquals(self.member._find_known_bookmark('http://1.example.com/'), None)
+
+	def testCommitAlias(self):
+		self.api.fake_added_bookmarks = []
+		self.state['known_bookmarks'] = [
+			dict(url='http://jmp.example.com/1', bookmark_id=1, hash='one', folder_id='unread')]
+		self.member.url_index.add_alias('http://jmp.example.com/1', 'http://1.example.com/')
+		self.member.commit_changes([dict(url='http://1.example.com/', state='archived')])
+		self.assertEquals(self.api.fake_added_bookmarks, [dict(url='http://jmp.example.com/1', folder_id='archive')])
+
+	def testConcurrentCommit(self):
+		self.api.fake_added_bookmarks = []
+		self.member.commit_workers = 4
+		changes = [dict(url='http://%d.example.com/' % (i), state='unread') for i in range(20)]
+		self.member.commit_changes(changes)
+		self.assertEquals(sorted(b['url'] for b in self.api.fake_added_bookmarks), sorted(c['url'] for c in changes))
+		self.assertEquals([b['url'] for b in self.state['known_bookmarks']], [c['url'] for c in changes])
+
+	def testNoEchoRecorded(self):
+		self.api.fake_added_bookmarks = []
+		self.member.commit_changes([dict(url='http://1.example.com/', state='archived')])
+		# the bookmark is on the 'have' list, it won't be returned by bookmarks/list
+		self.assertEquals(self.member._have('archive'), '%d:%d' % (hash('http://1.example.com/'), hash('http://1.example.com/')))
+		self.assertEquals(self.state.get('recent_commits', {}), {})
+
+
+class PagingInstapaperApi(FakeInstapaperApi):
+	"""Fake API that honors the 'have' and 'limit' arguments"""
+	def list_bookmarks(self, folder_id='unread', have='', limit='500', **kwargs):
+		self.list_calls = getattr(self, 'list_calls', 0) + 1
+		have = set(have.split(','))
+		r = [dict(type='meta')]
+		for b in self.fake_bookmarks.get(folder_id, []):
+			if len(r) > int(limit):
+				break
+			if '%s:%s' % (b['bookmark_id'], b['hash']) not in have:
+				r.append(b)
+		return r
+
+class InstapaperPagingTest(unittest.TestCase):
+	def setUp(self):
+		self.api = PagingInstapaperApi()
+		self.state = {}
+		self.member = sync.InstapaperMember(self.api, self.state, page_size=3)
+
+	def testDrainFolder(self):
+		self.api.fake_bookmarks = {'unread':[
+			dict(type='bookmark', bookmark_id=i, hash='h%d' % (i), url='http://%d.example.com/' % (i))
+			for i in range(10)]}
+		changes = list(self.member.get_changes())
+		self.assertEquals([c['url'] for c in changes], ['http://%d.example.com/' % (i) for i in range(10)])
+		self.assertEquals(self.api.list_calls, 4 + 1) # 4 pages on 'unread', 1 on 'archive'
+		self.assertEquals(len(self.state['known_bookmarks']), 10)
+
+	def testNoPagination(self):
+		self.member.paginate = False
+		self.api.fake_bookmarks = {'unread':[
+			dict(type='bookmark', bookmark_id=i, hash='h%d' % (i), url='http://%d.example.com/' % (i))
+			for i in range(10)]}
+		changes = list(self.member.get_changes())
+		self.assertEquals(len(changes), 3)
+
+	def testParallelFolders(self):
+		self.member.parallel_folders = True
+		self.api.fake_bookmarks = {
+			'unread':[dict(type='bookmark', bookmark_id=i, hash='h%d' % (i), url='http://%d.example.com/' % (i)) for i in range(10)],
+			'archive':[dict(type='bookmark', bookmark_id=i, hash='h%d' % (i), url='http://%d.example.com/' % (i)) for i in range(10, 15)]}
+		changes = list(self.member.get_changes())
+		self.assertEquals(sorted(c['url'] for c in changes if c['state'] == 'unread'),
+		                  sorted('http://%d.example.com/' % (i) for i in range(10)))
+		self.assertEquals(sorted(c['url'] for c in changes if c['state'] == 'archived'),
+		                  sorted('http://%d.example.com/' % (i) for i in range(10, 15)))
+		self.assertEquals(self.member._have('archive').count(':'), 5)
+
+	def testArchivedAgain(self):
+		self.api.fake_added_bookmarks = []
+		url = 'http://1.example.com/'
+		self.member.commit_changes([dict(url=url, state='archived')])
+		self.api.fake_bookmarks = {'archive': [dict(type='bookmark', url=url, bookmark_id=hash(url), hash=hash(url))]}
+		self.assertEquals(list(self.member.get_changes()), [])
+		# the user moves the bookmark back to unread, and archives it again
+		self.api.fake_bookmarks = {'unread': [dict(type='bookmark', url=url, bookmark_id=hash(url), hash='h2')]}
+		self.assertEquals(list(self.member.get_changes()), [dict(url=url, state='unread')])
+		self.api.fake_bookmarks = {'archive': [dict(type='bookmark', url=url, bookmark_id=hash(url), hash='h3')]}
+		self.assertEquals(list(self.member.get_changes()), [dict(url=url, state='archived')])
@@ -0,0 +1,36 @@
+from syncitlater import jsonstream
+import unittest
+import json
+import StringIO
+
+class JsonStreamTest(unittest.TestCase):
+	def decode(self, data, key='list', bufsize=7):
+		rest = {}
+		items = list(jsonstream.iter_object_items(StringIO.StringIO(data), key, rest, bufsize=bufsize))
+		return items, rest
+
+	def testObject(self):
+		doc = {'status': 1, 'list': {'1': {'item_id': '1', 'given_url': 'http://1.example.com/'},
+		                             '2': {'item_id': '2', 'time_updated': 12345678}},
+		       'since': 1234567890, 'complete': 1}
+		items, rest = self.decode(json.dumps(doc, indent=1))
+		self.assertEquals(dict(items), doc['list'])
+		self.assertEquals(rest, dict(status=1, since=1234567890, complete=1))
+
+	def testEmptyList(self):
+		# Pocket returns an empty list instead of an empty object
+		items, rest = self.decode('{"status": 2, "list": [], "since": 1000}')
+		self.assertEquals(items, [])
+		self.assertEquals(rest, dict(status=2, since=1000))
+
+	def testEmptyDocument(self):
+		self.assertEquals(self.decode(' { } '), ([], {}))
+
+	def testNumberOnBufferBoundary(self):
+		for bufsize in range(1, 20):
+			items, rest = self.decode('{"list": {"a": 123456789, "b": [1, 2.5]}, "x": 1000}', bufsize=bufsize)
+			self.assertEquals(items, [(u'a', 123456789), (u'b', [1, 2.5])])
+			self.assertEquals(rest, dict(x=1000))
+
+	def testTruncated(self):
+		self.assertRaises(ValueError, self.decode, '{"list": {"a": 1, "b"')
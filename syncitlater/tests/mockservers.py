@@ -0,0 +1,272 @@
+"""In-process mock servers for the Pocket v3 and Instapaper 1 APIs
+
+The servers implement only the endpoints used by PocketApi and
+InstapaperApi, and can be used to exercise the real HTTP, JSON and OAuth
+code paths. Point the API objects at them using the 'api_base' argument:
+
+	server = MockPocketServer(latency=0.1)
+	server.start()
+	api = pocket.PocketApi('key', state, api_base=server.api_base)
+	...
+	server.stop()
+"""
+import BaseHTTPServer, SocketServer
+import threading, time
+import random
+import json
+import urllib, urlparse
+import gzip, StringIO
+import oauth2
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# buffer the response, so it's not split on many small TCP segments
+	wbufsize = -1
+
+	def do_POST(self):
+		server = self.server
+		body = self.rfile.read(int(self.headers.getheader('content-length', '0')))
+		path = self.path.split('?')[0]
+		with server.lock:
+			server.requests.append((path, body))
+		if server.latency:
+			time.sleep(server.latency)
+
+		error = server.next_error()
+		if error == 'drop':
+			# the request is processed, but the response is lost
+			server.handle_api(path[len(server.base_path):], body, self.headers)
+			self.close_connection = 1
+			return
+		if error:
+			status, headers, data = server.error_response(error)
+		else:
+			status, headers, data = server.handle_api(path[len(server.base_path):], body, self.headers)
+
+		if 'gzip' in self.headers.getheader('accept-encoding', ''):
+			f = StringIO.StringIO()
+			g = gzip.GzipFile(fileobj=f, mode='w')
+			g.write(data)
+			g.close()
+			data = f.getvalue()
+			headers['Content-Encoding'] = 'gzip'
+		self.send_response(status)
+		for k,v in headers.items():
+			self.send_header(k, v)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""Base class for the mock API servers
+
+	latency is the time (in seconds) each response is delayed. Errors can
+	be injected using error_rate (the probability of a request failing with
+	HTTP status 503), or by adding HTTP status codes to the 'errors' list,
+	which are returned by the next requests, in order. A 'drop' item on
+	the list makes the server process the request, and then close the
+	connection without sending the response.
+	"""
+	daemon_threads = True
+	base_path = '/'
+
+	def __init__(self, latency=0, error_rate=0.0, retry_after=None):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockHandler)
+		self.latency = latency
+		self.error_rate = error_rate
+		self.retry_after = retry_after
+		self.errors = []
+		self.requests = []
+		self.lock = threading.Lock()
+		self._random = random.Random(0)
+
+	@property
+	def api_base(self):
+		return 'http://127.0.0.1:%d%s' % (self.server_port, self.base_path)
+
+	def start(self):
+		t = threading.Thread(target=self.serve_forever, args=(0.05,))
+		t.daemon = True
+		t.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def next_error(self):
+		with self.lock:
+			if self.errors:
+				return self.errors.pop(0)
+			if self.error_rate and self._random.random() < self.error_rate:
+				return 503
+
+	def error_response(self, status):
+		headers = {'Content-Type': 'application/json'}
+		if self.retry_after is not None:
+			headers['Retry-After'] = str(self.retry_after)
+		return status, headers, json.dumps(dict(error='Injected error %d' % (status)))
+
+	def handle_api(self, method, body, headers):
+		raise NotImplementedError()
+
+
+class MockPocketServer(MockServer):
+	"""Mock Pocket v3 API server
+
+	Implements oauth/request, oauth/authorize, get and send.
+	"""
+	base_path = '/v3/'
+
+	def __init__(self, consumer_key='pocket-key', **kwargs):
+		MockServer.__init__(self, **kwargs)
+		self.consumer_key = consumer_key
+		self.access_token = 'pocket-access-token'
+		self.username = 'pocketuser'
+		self.items = {}
+		self.next_item_id = 1
+		self.now = 1350000000
+
+	def add_item(self, url, status='0', time_updated=None):
+		with self.lock:
+			item_id = str(self.next_item_id)
+			self.next_item_id += 1
+			if time_updated is None:
+				self.now += 1
+				time_updated = self.now
+			self.items[item_id] = dict(item_id=item_id, given_url=url, resolved_url=url,
+			                           status=status, time_added=str(time_updated),
+			                           time_updated=str(time_updated))
+			return self.items[item_id]
+
+	def add_library(self, count, archived_ratio=0.5, seed=0):
+		"""Add 'count' synthetic items"""
+		rnd = random.Random(seed)
+		for i in range(count):
+			self.add_item('http://example.com/pocket/%d' % (i),
+			              rnd.random() < archived_ratio and '1' or '0')
+
+	def handle_api(self, method, body, headers):
+		args = json.loads(body)
+		if method == 'oauth/request':
+			return 200, {}, json.dumps(dict(code='request-code'))
+		if method == 'oauth/authorize':
+			return 200, {}, json.dumps(dict(access_token=self.access_token, username=self.username))
+		if args.get('consumer_key') != self.consumer_key or args.get('access_token') != self.access_token:
+			return 401, {'X-Error': 'Invalid access token'}, ''
+		if method == 'get':
+			return 200, {}, json.dumps(self.get(args))
+		if method == 'send':
+			return 200, {}, json.dumps(self.send(args['actions']))
+		return 404, {}, ''
+
+	def get(self, args):
+		with self.lock:
+			items = self.items.values()
+		since = int(args.get('since', 0))
+		items = [i for i in items if int(i['time_updated']) > since]
+		reverse = args.get('sort', 'newest') != 'oldest'
+		items.sort(key=lambda i: (int(i['time_added']), int(i['item_id'])), reverse=reverse)
+		offset = int(args.get('offset', 0))
+		items = items[offset:]
+		if args.has_key('count'):
+			items = items[:int(args['count'])]
+		# Pocket returns an empty list instead of an empty object
+		l = dict((i['item_id'], i) for i in items) or []
+		return dict(status=1, complete=1, list=l, since=self.now)
+
+	def send(self, actions):
+		results = []
+		for a in actions:
+			with self.lock:
+				self.now += 1
+				item = a.has_key('item_id') and self.items.get(str(a['item_id']))
+			if a['action'] == 'add':
+				if item:
+					item.update(status='0', time_updated=str(self.now))
+				else:
+					item = self.add_item(a['url'])
+				results.append(item)
+			elif a['action'] == 'archive' and item:
+				item.update(status='1', time_updated=str(self.now))
+				results.append(True)
+			else:
+				results.append(False)
+		return dict(status=1, action_results=results)
+
+
+class MockInstapaperServer(MockServer):
+	"""Mock Instapaper 1 API server
+
+	Implements oauth/access_token, account/verify_credentials,
+	bookmarks/list and bookmarks/add. OAuth signatures are checked.
+	"""
+	base_path = '/api/1/'
+
+	def __init__(self, consumer_key='instapaper-key', consumer_secret='instapaper-secret', **kwargs):
+		MockServer.__init__(self, **kwargs)
+		self.consumer = oauth2.Consumer(consumer_key, consumer_secret)
+		self.token = oauth2.Token('instapaper-token', 'instapaper-token-secret')
+		self.username = 'instapaperuser'
+		self.password = 'secret'
+		self.folders = dict(unread=[], archive=[])
+		self.next_bookmark_id = 1
+		self._oauth = oauth2.Server()
+		self._oauth.add_signature_method(oauth2.SignatureMethod_HMAC_SHA1())
+
+	def add_bookmark(self, url, folder_id='unread'):
+		with self.lock:
+			for f in self.folders.values():
+				for b in f:
+					if b['url'] == url:
+						f.remove(b)
+						break
+			b = dict(type='bookmark', bookmark_id=self.next_bookmark_id, url=url,
+			         hash='h%d' % (self.next_bookmark_id), time=int(time.time()))
+			self.next_bookmark_id += 1
+			self.folders[folder_id].append(b)
+			return b
+
+	def add_library(self, count, archived_ratio=0.5, seed=0):
+		"""Add 'count' synthetic bookmarks"""
+		rnd = random.Random(seed)
+		for i in range(count):
+			self.add_bookmark('http://example.com/instapaper/%d' % (i),
+			                  rnd.random() < archived_ratio and 'archive' or 'unread')
+
+	def _verify(self, method, body, token):
+		req = oauth2.Request.from_request('POST', self.api_base + method,
+		                                  query_string=body)
+		try:
+			self._oauth.verify_request(req, self.consumer, token)
+		except oauth2.Error:
+			return False
+		return True
+
+	def handle_api(self, method, body, headers):
+		args = dict(urlparse.parse_qsl(body))
+		if method == 'oauth/access_token':
+			if not self._verify(method, body, None) or args.get('x_auth_password') != self.password:
+				return 401, {}, ''
+			return 200, {}, urllib.urlencode(dict(oauth_token=self.token.key,
+			                                      oauth_token_secret=self.token.secret))
+		if args.get('oauth_token') != self.token.key or not self._verify(method, body, self.token):
+			return 401, {}, json.dumps([dict(type='error', error_code=403, message='Invalid token')])
+		if method == 'account/verify_credentials':
+			return 200, {}, json.dumps([dict(type='user', user_id=1, username=self.username)])
+		if method == 'bookmarks/list':
+			have = set(args.get('have', '').split(','))
+			limit = int(args.get('limit', '25'))
+			with self.lock:
+				bookmarks = [b for b in self.folders.get(args.get('folder_id', 'unread'), [])
+				             if '%s:%s' % (b['bookmark_id'], b['hash']) not in have][:limit]
+			return 200, {}, json.dumps([dict(type='meta'), dict(type='user', user_id=1)] + bookmarks)
+		if method == 'bookmarks/add':
+			if not args.get('url', '').startswith(('http://', 'https://')):
+				return 400, {}, json.dumps([dict(type='error', error_code=1240, message='Invalid URL specified')])
+			return 200, {}, json.dumps([self.add_bookmark(args['url'], args.get('folder_id', 'unread'))])
+		return 404, {}, ''
@@ -29,8 +29,26 @@ class FakePocketApi:
 		self.since_arg = kwargs.get('since')
 		return self.fake_data
 
+	def api_get_items(self, rest=None, **kwargs):
+		items = self.api_get(**kwargs)['list'].values()
+		if rest is not None and items:
+			# the server clock, as far as the fake data knows
+			rest['since'] = max(int(i['time_updated']) for i in items)
+		if kwargs.has_key('count'):
+			items.sort(key=lambda i: int(i.get('time_added', i['time_updated'])))
+			offset = int(kwargs.get('offset', 0))
+			items = items[offset:offset + int(kwargs['count'])]
+		return items
+
 	def send_actions(self, actions):
 		self.fake_actions.extend(actions)
+		return dict(status=1, action_results=[True for a in actions])
+
+class UnpagedPocketApi(FakePocketApi):
+	"""Fake API that ignores the 'count' and 'offset' arguments"""
+	def api_get_items(self, **kwargs):
+		self.get_calls = getattr(self, 'get_calls', 0) + 1
+		return self.api_get(**kwargs)['list'].values()
 
 class PocketSyncTest(unittest.TestCase):
 	def setUp(self):
@@ -103,3 +121,132 @@ class PocketSyncTest(unittest.TestCase):
 		])
 		# should have logged a warning about the unknown item_id for the archived item
 		self.assertEquals(len(self.member.state.get('warnings',[])), 0)
+
+	def testChunkedCommit(self):
+		calls = []
+		def send_actions(actions):
+			calls.append(actions)
+			return dict(status=1, action_results=[True for a in actions])
+		self.api.send_actions = send_actions
+		self.member.chunk_size = 3
+		self.member.commit_changes([dict(url='http://%d.example.com/' % (i), state='unread') for i in range(10)])
+		self.assertEquals([len(c) for c in calls], [3, 3, 3, 1])
+
+	def testRetryFailedActions(self):
+		calls = []
+		def send_actions(actions):
+			calls.append(actions)
+			# fail the first action on each request, the first time it is sent
+			results = [True for a in actions]
+			if len(calls) == 1:
+				results[0] = False
+			else:
+				results[0] = dict(item_id='1001')
+			return dict(status=1, action_results=results)
+		self.api.send_actions = send_actions
+		self.member.commit_changes([
+			dict(url='http://1.example.com/', state='unread'),
+			dict(url='http://2.example.com/', state='unread'),
+		])
+		self.assertEquals(calls, [
+			[dict(action='add', url='http://1.example.com/'), dict(action='add', url='http://2.example.com/')],
+			[dict(action='add', url='http://1.example.com/')],
+		])
+		self.assertEquals(self.member.find_item_id('http://1.example.com/'), '1001')
+		self.assertEquals(self.member.state.get('warnings', []), [])
+
+	def testFailedRequestNotResent(self):
+		calls = []
+		def send_actions(actions):
+			calls.append(actions)
+			raise IOError('Connection reset by peer')
+		self.api.send_actions = send_actions
+		self.member.commit_changes([dict(url='http://1.example.com/', state='unread')])
+		# the transport already retried it
+		self.assertEquals(len(calls), 1)
+		self.assertEquals(len(self.state['warnings']), 1)
+
+	def testEchoSuppression(self):
+		self.state['url_item_ids'] = {'http://2.example.com/': '2'}
+		self.member.commit_changes([
+			dict(url='http://1.example.com/', state='unread'),
+			dict(url='http://2.example.com/', state='archived'),
+		])
+		self.api.fake_data = {'list':{
+			'1': dict(status='0', item_id='1', given_url='http://1.example.com/', resolved_url='http://1.example.com/a', time_updated='12345'),
+			'2': dict(status='1', item_id='2', given_url='http://2.example.com/', time_updated='12346'),
+			'3': dict(status='0', item_id='3', given_url='http://3.example.com/', time_updated='12347'),
+		}}
+		self.assertEquals(list(self.member.get_changes()), [dict(url='http://3.example.com/', state='unread')])
+		self.assertEquals(self.state['last_update_timestamp'], 12347)
+		self.assertEquals(self.member.find_item_id('http://1.example.com/a'), '1')
+		# the same change coming again is not an echo anymore
+		self.assertEquals(len(list(self.member.get_changes())), 3)
+
+	def testInitialPages(self):
+		self.api.fake_data = {'list':dict((str(i), dict(status='0', item_id=str(i), given_url='http://%d.example.com/' % (i),
+		                                                 time_updated=str(10000 + i))) for i in range(2500))}
+		changes = list(self.member.get_changes())
+		self.assertEquals([c['url'] for c in changes], ['http://%d.example.com/' % (i) for i in range(2500)])
+		self.assertEquals(self.state['last_update_timestamp'], 12499)
+
+	def testChangedDuringInitialPages(self):
+		class ChangingPocketApi(FakePocketApi):
+			def api_get(self, **kwargs):
+				items = self.fake_data['list']
+				if int(kwargs.get('offset', 0)) > 0 and items.has_key('1'):
+					# an item on the first page is archived, and another is deleted
+					items['0'].update(status='1', time_updated='10010')
+					del items['1']
+				since = int(kwargs.get('since', 0))
+				return {'list':dict((k, i) for k,i in items.items() if int(i['time_updated']) > since)}
+		self.api = ChangingPocketApi()
+		self.member = sync.PocketMember(self.api, self.state, initial_page_size=4, initial_workers=1)
+		self.api.fake_data = {'list':dict((str(i), dict(status='0', item_id=str(i), given_url='http://%d.example.com/' % (i),
+		                                                 time_added=str(10000 + i), time_updated=str(10000 + i))) for i in range(10))}
+		changes = list(self.member.get_changes())
+		self.assertEquals(sorted(c['url'] for c in changes), sorted('http://%d.example.com/' % (i) for i in range(10)))
+		# the cursor is the time of the first page, not of the newest change
+		self.assertEquals(self.state['last_update_timestamp'], 10009)
+		self.assertEquals(list(self.member.get_changes()), [dict(url='http://0.example.com/', state='archived')])
+
+	def testInitialPagesIgnored(self):
+		self.api = UnpagedPocketApi()
+		self.member = sync.PocketMember(self.api, self.state, initial_page_size=5, initial_workers=2)
+		self.api.fake_data = {'list':dict((str(i), dict(status='0', item_id=str(i), given_url='http://%d.example.com/' % (i),
+		                                                 time_updated=str(10000 + i))) for i in range(5))}
+		self.assertEquals(len(list(self.member.get_changes())), 5)
+		# the first page, and one round that brought nothing new
+		self.assertEquals(self.api.get_calls, 3)
+		self.assertEquals(len(self.state['warnings']), 1)
+
+	def testEchoForgottenOnOtherState(self):
+		self.member.commit_changes([dict(url='http://1.example.com/', state='unread')])
+		# the user archives the item before we see our own commit
+		self.api.fake_data = {'list':{
+			'1': dict(status='1', item_id='1', given_url='http://1.example.com/', time_updated='12345'),
+		}}
+		self.assertEquals(list(self.member.get_changes()), [dict(url='http://1.example.com/', state='archived')])
+		self.assertEquals(self.state['recent_commits'], {})
+		# and moves it back to unread
+		self.api.fake_data = {'list':{
+			'1': dict(status='0', item_id='1', given_url='http://1.example.com/', time_updated='12346'),
+		}}
+		self.assertEquals(list(self.member.get_changes()), [dict(url='http://1.example.com/', state='unread')])
+
+	def testResolvedUrlAlias(self):
+		self.api.fake_data = {'list':{
+			'1': dict(status='0', item_id='1', given_url='http://jmp.example.com/1', resolved_url='http://1.example.com/', time_updated='12345'),
+		}}
+		list(self.member.get_changes())
+		self.member.commit_changes([dict(url='http://JMP.example.com/1?utm_source=x', state='archived')])
+		self.assertEquals(self.api.fake_actions, [dict(action='archive', item_id='1')])
+
+	def testEchoExpiration(self):
+		self.member.commit_changes([dict(url='http://1.example.com/', state='unread')])
+		self.state['recent_commits']['http://1.example.com/'][1] -= self.member.echo_ttl + 1
+		self.api.fake_data = {'list':{
+			'1': dict(status='0', item_id='1', given_url='http://1.example.com/', time_updated='12345'),
+		}}
+		self.assertEquals(list(self.member.get_changes()), [dict(url='http://1.example.com/', state='unread')])
+		self.assertEquals(self.state['recent_commits'], {})
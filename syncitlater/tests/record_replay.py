@@ -0,0 +1,77 @@
+from syncitlater import sync, pocket, instapaper, transport, cassette
+from syncitlater.tests.mockservers import MockPocketServer, MockInstapaperServer
+import unittest
+import os, shutil, tempfile
+import gzip
+
+class RecordReplayTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'cassette.gz')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def members(self, t, api_base):
+		pocketapi = pocket.PocketApi('pocket-key', dict(access_token='pocket-access-token', username='u'),
+		                             transport=t, api_base=api_base[0])
+		instapaperapi = instapaper.InstapaperApi('instapaper-key', 'instapaper-secret',
+		                                         dict(oauth_token='instapaper-token', oauth_token_secret='instapaper-token-secret'),
+		                                         transport=t, api_base=api_base[1])
+		return [sync.PocketMember(pocketapi, {}), sync.InstapaperMember(instapaperapi, {}, page_size=50)]
+
+	def testReplay(self):
+		servers = [MockPocketServer(), MockInstapaperServer()]
+		for s in servers:
+			s.start()
+			s.add_library(120)
+		api_base = [s.api_base for s in servers]
+		try:
+			t = cassette.RecordingTransport(transport.HttpTransport(), self.path)
+			recorded = [list(m.get_changes()) for m in self.members(t, api_base)]
+			t.close()
+		finally:
+			for s in servers:
+				s.stop()
+
+		# the servers are gone. Everything must come from the cassette
+		t = cassette.ReplayTransport(self.path)
+		members = self.members(t, api_base)
+		self.assertEquals([list(m.get_changes()) for m in members], recorded)
+		self.assertEquals(len(recorded[0]), 120)
+		self.assertEquals(len(recorded[1]), 120)
+		self.assertRaises(cassette.CassetteMiss, members[0].api.api_get, count=1)
+
+	def testAuthNotRecorded(self):
+		servers = [MockPocketServer(), MockInstapaperServer()]
+		for s in servers:
+			s.start()
+		try:
+			t = cassette.RecordingTransport(transport.HttpTransport(), self.path)
+			pocketstate, instapaperstate = {}, {}
+			pocketapi = pocket.PocketApi('pocket-key', pocketstate, transport=t, api_base=servers[0].api_base)
+			pocketapi.start_auth('http://example.com/')
+			pocketapi.auth_finished()
+			self.assertTrue(pocketapi.test_auth())
+			instapaperapi = instapaper.InstapaperApi('instapaper-key', 'instapaper-secret', instapaperstate,
+			                                         transport=t, api_base=servers[1].api_base)
+			instapaperapi.authenticate('instapaperuser', 'secret')
+			self.assertTrue(instapaperapi.test_auth())
+			t.close()
+		finally:
+			for s in servers:
+				s.stop()
+		data = gzip.open(self.path, 'rb').read()
+		# only the credential checks were recorded
+		self.assertEquals(len(data.splitlines()), 2)
+		for secret in (pocketstate['access_token'], instapaperstate['oauth_token'], instapaperstate['oauth_token_secret']):
+			self.assertFalse(secret in data)
+
+	def testRequestKey(self):
+		form = {'Content-Type': 'application/x-www-form-urlencoded'}
+		k = cassette.request_key('POST', 'http://example.com/a', 'x=1&oauth_nonce=1&oauth_signature=a', form)
+		self.assertEquals(k, cassette.request_key('POST', 'http://example.com/a', 'oauth_nonce=2&x=1', form))
+		self.assertNotEquals(k, cassette.request_key('POST', 'http://example.com/a', 'x=2', form))
+		json_type = {'Content-Type': 'application/json'}
+		self.assertEquals(cassette.request_key('POST', 'http://example.com/a', '{"a": 1, "b": 2}', json_type),
+		                  cassette.request_key('POST', 'http://example.com/a', '{"b":2,"a":1}', json_type))
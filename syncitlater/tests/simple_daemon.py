@@ -0,0 +1,158 @@
+import sys, types
+try:
+	from syncitlater import settings
+except ImportError:
+	# simple_tool only needs the API keys from the user's settings
+	sys.modules['syncitlater.settings'] = types.ModuleType('syncitlater.settings')
+from syncitlater import simple_tool, sync
+import unittest
+import os, shutil, tempfile, signal
+import time
+import json, argparse
+import logging
+from StringIO import StringIO
+
+class MemoryStore(object):
+	path = 'memory'
+
+	def __init__(self):
+		self.saved = {}
+		self.saves = 0
+
+	def load(self):
+		return json.loads(json.dumps(self.saved))
+
+	def save(self, state):
+		self.saved = json.loads(json.dumps(state))
+		self.saves += 1
+
+class FakeTime(object):
+	"""Replacement for the time module used by simple_tool"""
+	def __init__(self):
+		self.now = 1000.0
+
+	def time(self):
+		return self.now
+
+class FakeStop(object):
+	"""Replacement for SimpleSync.stop that records the waits (advancing the clock), and stops after some waits"""
+	def __init__(self, runs, clock):
+		self.runs = runs
+		self.clock = clock
+		self.waits = []
+
+	def is_set(self):
+		return len(self.waits) >= self.runs
+
+	def set(self):
+		self.runs = 0
+
+	def wait(self, timeout):
+		self.waits.append(timeout)
+		self.clock.now += timeout
+
+class Unavailable(Exception):
+	pass
+
+class ScriptedMember(sync.SyncMember):
+	"""Member returning the next list of changes from a script on each run"""
+	def __init__(self, state, script, failures):
+		super(ScriptedMember, self).__init__(state)
+		self.script = script
+		self.failures = failures
+
+	def get_changes(self):
+		return self.script.pop(0)
+
+	def commit_changes(self, changes):
+		if self.failures and self.failures.pop(0):
+			raise Unavailable()
+		self.state.setdefault('committed', []).extend(changes)
+
+class DaemonSync(simple_tool.SimpleSync):
+	def __init__(self, store, journal_path, scripts, failures):
+		simple_tool.SimpleSync.__init__(self, store, journal_path)
+		self.scripts = scripts
+		self.failures = failures
+
+	def make_apis(self):
+		pass
+
+	def check_auth(self, max_age=None):
+		return True
+
+	def make_engine(self, args, resume=True):
+		members = [ScriptedMember(self.state['member_states'][i], self.scripts[i], self.failures[i]) for i in range(2)]
+		self.engine = sync.SyncEngine(self.state['engine_state'], members, journal=self.journal)
+		if resume:
+			self.resume()
+
+def change(n, state='unread'):
+	return dict(url='http://%d.example.com/' % (n), state=state)
+
+class DaemonTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.store = MemoryStore()
+		self.sigterm = signal.getsignal(signal.SIGTERM)
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+		self.clock = FakeTime()
+		simple_tool.time = self.clock
+		# the failed runs are logged by the root logger
+		self.handler = logging.NullHandler()
+		logging.getLogger().addHandler(self.handler)
+
+	def tearDown(self):
+		logging.getLogger().removeHandler(self.handler)
+		sys.stdout = self.stdout
+		simple_tool.time = time
+		signal.signal(signal.SIGTERM, self.sigterm)
+		shutil.rmtree(self.dir)
+
+	def args(self, **kwargs):
+		args = argparse.Namespace(interval=10, max_interval=40, flush_interval=1e9, auth_ttl=None,
+		                          parallel=False, fetch_timeout=None, dry_run=True, interactive=False)
+		args.__dict__.update(kwargs)
+		return args
+
+	def run_daemon(self, s, runs, args):
+		s.stop = FakeStop(runs, self.clock)
+		self.assertEquals(s.daemon(args), 0)
+		return s.stop.waits
+
+	def testInterval(self):
+		scripts = [[[change(1)], [], [], [], [change(2)], []], [[]] * 6]
+		s = DaemonSync(self.store, None, scripts, [[], []])
+		waits = self.run_daemon(s, 6, self.args())
+		# back to the minimum interval after changes, doubling up to the maximum when idle
+		self.assertEquals(waits, [10, 20, 40, 40, 10, 20])
+		self.assertEquals(self.store.saved['member_states'][1]['committed'], [change(1), change(2)])
+		# saved after each commit, and on exit because the last run was idle
+		self.assertEquals(self.store.saves, 3)
+
+	def testFlushInterval(self):
+		scripts = [[[change(1)], [], []], [[]] * 3]
+		s = DaemonSync(self.store, None, scripts, [[], []])
+		self.run_daemon(s, 3, self.args(flush_interval=0))
+		# the idle runs are saved right away, so nothing is left to save on exit
+		self.assertEquals(self.store.saves, 3)
+
+	def testFlushDeadline(self):
+		scripts = [[[change(1)], [], []], [[]] * 3]
+		s = DaemonSync(self.store, None, scripts, [[], []])
+		waits = self.run_daemon(s, 5, self.args(flush_interval=25))
+		# the idle runs wake up to save the state on time
+		self.assertEquals(waits, [10, 15, 5, 20, 20])
+		self.assertEquals(self.store.saves, 3)
+
+	def testFailedResume(self):
+		scripts = [[[change(1), change(2)], []], [[], []]]
+		# the commit fails, and the service is still down on the first resume
+		failures = [[], [True, True]]
+		s = DaemonSync(self.store, os.path.join(self.dir, 'journal'), scripts, failures)
+		waits = self.run_daemon(s, 3, self.args())
+		self.assertEquals(waits, [20, 40, 40])
+		self.assertEquals(self.store.saved['member_states'][1]['committed'], [change(1), change(2)])
+		self.assertEquals(s.journal.pending(), None)
+		self.assertEquals(scripts, [[], []])
@@ -0,0 +1,92 @@
+from syncitlater import statestore
+import unittest
+import os, shutil, tempfile
+import json
+
+class SqliteStateStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'state.db')
+		self.store = statestore.SqliteStateStore(self.path)
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.dir)
+
+	def reopen(self):
+		self.store.close()
+		self.store = statestore.SqliteStateStore(self.path)
+		return self.store.load()
+
+	def sampleState(self):
+		return {
+			'member_states': [
+				{'last_update_timestamp': 12345, 'url_item_ids': {'http://1.example.com/': '1'}},
+				{'known_bookmarks': [
+					dict(url='http://1.example.com/', bookmark_id=1, hash='one', folder_id='unread'),
+					dict(bookmark_id=2, hash='two')]},
+			],
+			'api_states': [{'access_token': 'x'}, {}],
+			'engine_state': {'foo': [1, 2, {'bar': None}], 'url_aliases': {'http://jmp.example.com/1': 'http://1.example.com/'}},
+		}
+
+	def testRoundTrip(self):
+		state = self.sampleState()
+		self.store.save(state)
+		self.assertEquals(self.reopen(), state)
+
+	def testIncrementalSave(self):
+		state = self.sampleState()
+		self.store.save(state)
+		state = self.reopen()
+		changes = self.store.db.total_changes
+		state['member_states'][1]['known_bookmarks'][1]['folder_id'] = 'archive'
+		state['member_states'][0]['url_item_ids']['http://2.example.com/'] = '2'
+		self.store.save(state)
+		self.assertEquals(self.store.db.total_changes - changes, 2)
+		self.store.save(state)
+		self.assertEquals(self.store.db.total_changes - changes, 2)
+		self.assertEquals(self.reopen(), state)
+
+	def testUrlMaps(self):
+		state = self.sampleState()
+		state['member_states'][0]['recent_commits'] = {'http://1.example.com/': ['unread', 1000]}
+		self.store.save(state)
+		state = self.reopen()
+		self.assertFalse(self.store.db.execute("SELECT * FROM state_values WHERE key IN ('url_aliases', 'recent_commits')").fetchall())
+		changes = self.store.db.total_changes
+		state['engine_state']['url_aliases']['http://jmp.example.com/2'] = 'http://2.example.com/'
+		state['member_states'][0]['recent_commits']['http://1.example.com/'] = ['archived', 1001]
+		self.store.save(state)
+		self.assertEquals(self.store.db.total_changes - changes, 2)
+		del state['member_states'][0]['recent_commits']
+		self.store.save(state)
+		self.assertEquals(self.store.db.total_changes - changes, 3)
+		self.assertEquals(self.reopen(), state)
+
+	def testRemovedItems(self):
+		state = self.sampleState()
+		self.store.save(state)
+		del state['member_states'][1]['known_bookmarks'][0]
+		del state['member_states'][0]['last_update_timestamp']
+		self.store.save(state)
+		self.assertEquals(self.reopen(), state)
+
+	def testWarningsNotLoaded(self):
+		state = self.sampleState()
+		state['engine_state']['warnings'] = ['one', 'two']
+		self.store.save(state)
+		state = self.reopen()
+		self.assertFalse(state['engine_state'].has_key('warnings'))
+		state['engine_state'].setdefault('warnings', []).append('three')
+		self.store.save(state)
+		self.assertEquals(self.store.warnings('engine_state'), ['one', 'two', 'three'])
+
+	def testMigrateJson(self):
+		state = self.sampleState()
+		jsonpath = os.path.join(self.dir, 'state.json')
+		json.dump(state, open(jsonpath, 'w'))
+		self.store.close()
+		os.unlink(self.path)
+		self.store = statestore.migrate_json(jsonpath, self.path)
+		self.assertEquals(self.reopen(), state)
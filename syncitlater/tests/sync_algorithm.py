@@ -1,6 +1,8 @@
 
-from syncitlater import sync
+from syncitlater import sync, dispatch
 import unittest
+import threading
+import time
 
 class FakeMember:
 	def __init__(self):
@@ -119,3 +121,210 @@ class PocketSyncTest(unittest.TestCase):
 			dict(url='http://1.example.com/', state='archived'),
 			dict(url='http://2.example.com/', state='unread'),
 		])
+
+	def testSharedChanges(self):
+		m3 = FakeMember()
+		self.engine.members.append(m3)
+		self.m1.fake_changes = [dict(url='http://1.example.com/', state='unread')]
+		result = list(self.engine.calculate_sync())
+		self.assertEquals(result[0][1], [])
+		self.assertTrue(result[1][1][0] is result[2][1][0])
+		self.assertRaises(TypeError, result[1][1][0].__setitem__, 'state', 'archived')
+
+	def testUnsolvableConflict(self):
+		self.m1.fake_changes = [dict(url='http://1.example.com/', state='unread', tags='foo')]
+		self.m2.fake_changes = [dict(url='http://1.example.com/', state='archived')]
+		self.engine.synchronize()
+		self.assertEquals(self.m1.committed_changes, [])
+		self.assertEquals(self.m2.committed_changes, [])
+		self.assertEquals(len(self.state['warnings']), 1)
+
+	def testDifferentVersions(self):
+		changes = [
+			dict(url='http://1.example.com/', state='unread'),
+			sync.Change(url='http://1.example.com/', state='archived'),
+			sync.Change(url='http://1.example.com/', state='unread'),
+			dict(url='http://1.example.com/', state='archived'),
+		]
+		self.assertEquals(self.engine.different_versions(changes), changes[:2])
+
+	def testUnhashableValues(self):
+		changes = [
+			dict(url='http://1.example.com/', state='unread', tags=['a', 'b']),
+			dict(url='http://1.example.com/', state='unread', tags=['a', 'b']),
+			dict(url='http://1.example.com/', state='unread', tags=['b']),
+		]
+		self.assertEquals(self.engine.different_versions(changes), [changes[0], changes[2]])
+		self.assertEquals(hash(sync.Change(changes[0])), hash(sync.Change(changes[1])))
+
+	def testParallelFetch(self):
+		self.engine.parallel = True
+		self.m1.fake_changes = [dict(url='http://1.example.com/', state='archived')]
+		self.m2.fake_changes = [dict(url='http://2.example.com/', state='unread')]
+		self.engine.synchronize()
+		self.assertEquals(self.m1.committed_changes, [dict(url='http://2.example.com/', state='unread')])
+		self.assertEquals(self.m2.committed_changes, [dict(url='http://1.example.com/', state='archived')])
+
+	def testFetchTimeout(self):
+		class SlowMember(FakeMember):
+			def get_changes(self):
+				time.sleep(0.5)
+				return []
+		self.engine.members[1] = SlowMember()
+		self.engine.parallel = True
+		self.engine.fetch_timeout = [None, 0.05]
+		self.assertRaises(sync.FetchTimeout, self.engine.synchronize)
+
+	def testFetchTimeoutState(self):
+		class SlowPocketApi:
+			def api_get_items(self, **kwargs):
+				time.sleep(0.2)
+				return [dict(item_id='1', given_url='http://1.example.com/', status='0', time_updated='12345')]
+		state = {}
+		self.engine.members[1] = sync.PocketMember(SlowPocketApi(), state, initial_page_size=None)
+		self.engine.parallel = True
+		self.engine.fetch_timeout = [None, 0.05]
+		self.assertRaises(sync.FetchTimeout, self.engine.synchronize)
+		# the abandoned fetch finishes its request, but leaves the state alone
+		time.sleep(0.3)
+		self.assertEquals(state, {})
+
+	def testParallelCommit(self):
+		class Failed(Exception):
+			pass
+		def slow_commit(changes):
+			time.sleep(0.2)
+			raise Failed()
+		self.m1.commit_changes = slow_commit
+		self.engine.parallel = True
+		self.m1.fake_changes = [dict(url='http://1.example.com/', state='archived')]
+		self.m2.fake_changes = [dict(url='http://2.example.com/', state='unread')]
+		self.assertRaises(Failed, self.engine.synchronize)
+		# the other member is committed anyway
+		self.assertEquals(self.m2.committed_changes, [dict(url='http://1.example.com/', state='archived')])
+
+	def testJournal(self):
+		import os, shutil, tempfile
+		from syncitlater.journal import CommitJournal
+		d = tempfile.mkdtemp()
+		try:
+			saved = []
+			def save():
+				saved.append(list(self.m2.committed_changes))
+			journal = CommitJournal(os.path.join(d, 'journal'), save, chunk_size=2)
+			self.engine.journal = journal
+			class Interrupted(Exception):
+				pass
+			def commit_changes(changes):
+				if len(self.m2.committed_changes) >= 2:
+					raise Interrupted()
+				self.m2.committed_changes.extend(changes)
+			self.m2.commit_changes = commit_changes
+			self.m1.fake_changes = [dict(url='http://%d.example.com/' % (i), state='unread') for i in range(5)]
+			self.assertRaises(Interrupted, self.engine.synchronize)
+			self.assertEquals(len(self.m2.committed_changes), 2)
+			# saved before the commit, and after the chunk committed
+			self.assertEquals(saved, [[], self.m1.fake_changes[:2]])
+
+			del self.m2.commit_changes
+			plan, done = journal.pending()
+			self.assertEquals(done, set([(1, 0)]))
+			self.assertTrue(self.engine.resume_sync())
+			self.assertEquals(self.m2.committed_changes, self.m1.fake_changes)
+			self.assertEquals(len(saved), 4)
+			self.assertEquals(journal.pending(), None)
+			self.assertFalse(self.engine.resume_sync())
+
+			# nothing is saved if there's nothing to commit
+			self.m1.fake_changes = []
+			self.engine.synchronize()
+			self.assertEquals(len(saved), 4)
+		finally:
+			shutil.rmtree(d)
+
+	def testJournalParallel(self):
+		import os, shutil, tempfile
+		from syncitlater.journal import CommitJournal
+		d = tempfile.mkdtemp()
+		try:
+			saved = []
+			def save():
+				saved.append((len(self.m1.committed_changes), len(self.m2.committed_changes)))
+			journal = CommitJournal(os.path.join(d, 'journal'), save, chunk_size=2)
+			self.engine = sync.SyncEngine(self.state, self.members, parallel=True, journal=journal)
+			class Failed(Exception):
+				pass
+			def commit_changes(changes):
+				if self.m1.committed_changes:
+					raise Failed()
+				self.m1.committed_changes.extend(changes)
+			self.m1.commit_changes = commit_changes
+			self.m1.fake_changes = [dict(url='http://%d.example.com/' % (i), state='unread') for i in range(5)]
+			self.m2.fake_changes = [dict(url='http://%d.example.org/' % (i), state='unread') for i in range(3)]
+			self.assertRaises(Failed, self.engine.synchronize)
+			# the other member runs until the end, and the state is
+			# saved between the rounds
+			self.assertEquals(self.m2.committed_changes, self.m1.fake_changes)
+			self.assertEquals(saved, [(0, 0), (2, 2), (2, 2), (2, 4), (2, 5)])
+			plan, done = journal.pending()
+			self.assertEquals(done, set([(0, 0), (1, 0), (1, 2), (1, 4)]))
+
+			del self.m1.commit_changes
+			self.assertTrue(self.engine.resume_sync())
+			self.assertEquals(self.m1.committed_changes, self.m2.fake_changes)
+			self.assertEquals(journal.pending(), None)
+		finally:
+			shutil.rmtree(d)
+
+	def testObserver(self):
+		from syncitlater.stats import SyncStats
+		stats = SyncStats()
+		self.engine = sync.SyncEngine(self.state, self.members, observer=stats)
+		self.m1.fake_changes = [
+			dict(url='http://1.example.com/', state='archived'),
+			dict(url='http://2.example.com/', state='unread'),
+		]
+		self.engine.synchronize()
+		phases = [(p['phase'], p['items']) for p in stats.report()['phases']]
+		self.assertEquals(phases, [('fetch', 2), ('fetch', 0), ('conflicts', 0), ('fanout', 2),
+		                           ('commit', 0), ('commit', 2)])
+
+	def testUrlAliases(self):
+		self.engine.url_index.add_alias('http://1.example.com/', 'http://www.example.com/1')
+		self.m1.fake_changes = [
+			dict(url='http://www.example.com/1', state='archived'),
+			dict(url='http://www.example.com/2?utm_source=feed', state='unread'),
+			dict(url='http://www.example.com/3', state='archived'),
+		]
+		self.m2.fake_changes = [
+			dict(url='http://1.example.com/', state='archived'),
+			dict(url='http://WWW.example.com/2', state='unread'),
+			dict(url='http://www.example.com/3#comments', state='unread'),
+		]
+		self.engine.synchronize()
+		self.assertEquals(self.m1.committed_changes, [dict(url='http://www.example.com/3', state='unread')])
+		self.assertEquals(self.m2.committed_changes, [])
+		self.assertEquals(self.state.get('warnings', []), [])
+
+
+class MergeTest(unittest.TestCase):
+	def testMerge(self):
+		items = sorted(dispatch.merge([iter(range(5)), iter(range(3))]))
+		self.assertEquals(items, [(0, i) for i in range(5)] + [(1, i) for i in range(3)])
+
+	def testClosed(self):
+		consumed = [0, 0]
+		def endless(i):
+			while True:
+				consumed[i] += 1
+				yield consumed[i]
+		before = set(threading.enumerate())
+		g = dispatch.merge([endless(0), endless(1)], maxsize=2)
+		g.next()
+		g.close()
+		time.sleep(0.1)
+		# the threads don't wait forever for room on the queue
+		self.assertEquals(set(threading.enumerate()) - before, set())
+		n = list(consumed)
+		time.sleep(0.1)
+		self.assertEquals(consumed, n)
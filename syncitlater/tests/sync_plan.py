@@ -0,0 +1,113 @@
+from syncitlater import sync, plan
+from syncitlater.tests.pocket_sync import FakePocketApi
+from syncitlater.tests.instapaper_sync import FakeInstapaperApi
+from syncitlater.tests.batch_sync import MockAccountTest
+from syncitlater import simple_tool, statestore, transport
+import unittest
+import os, sys, shutil, tempfile
+import gzip
+import json
+from StringIO import StringIO
+
+class SyncPlanTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'plan')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def testSaveLoad(self):
+		changes = [[sync.Change(url='http://1.example.com/', state='unread')], []]
+		state = {'member_states': [{'last_update_timestamp': 1000}, {}],
+		         'api_states': [{'access_token': 'secret-token'}, {'oauth_token_secret': 'secret'}]}
+		plan.save_plan(self.path, [None, 'abc'], changes, state)
+		p = plan.load_plan(self.path)
+		self.assertEquals(p['changes'], changes)
+		# credentials are not saved
+		self.assertEquals(p['state'], {'member_states': state['member_states']})
+		self.assertFalse('secret' in gzip.open(self.path, 'rb').read())
+		plan.check_plan(p, [None, 'abc'])
+		self.assertRaises(plan.StalePlan, plan.check_plan, p, [1000, 'abc'])
+		self.assertRaises(plan.StalePlan, plan.check_plan, p, [None])
+
+	def testCursors(self):
+		pocketapi = FakePocketApi()
+		pocketapi.fake_data = {'list': {
+			'1': dict(status='0', item_id='1', given_url='http://1.example.com/', time_updated='12345')}}
+		instapaperapi = FakeInstapaperApi()
+		instapaperapi.fake_bookmarks = {'unread': [dict(type='bookmark', url='http://2.example.com/', bookmark_id=2, hash='two')]}
+		engine = sync.SyncEngine({}, [sync.PocketMember(pocketapi, {}), sync.InstapaperMember(instapaperapi, {})])
+		before = engine.cursors()
+		list(engine.calculate_sync())
+		after = engine.cursors()
+		self.assertNotEquals(before[0], after[0])
+		self.assertNotEquals(before[1], after[1])
+		self.assertEquals(engine.cursors(), after)
+
+
+class ApplyPlanTest(MockAccountTest):
+	def setUp(self):
+		MockAccountTest.setUp(self)
+		self.state_path = os.path.join(self.dir, 'state.json')
+		self.plan_path = os.path.join(self.dir, 'plan')
+		json.dump(self.credentials(), open(self.state_path, 'w'))
+		self.pocket.add_library(5)
+		# archived bookmarks can't be added to Pocket
+		self.instapaper.add_library(3, archived_ratio=0)
+		self.transport = transport.HttpTransport()
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+		self.transport.close()
+		MockAccountTest.tearDown(self)
+
+	def run_tool(self, method, **kwargs):
+		s = simple_tool.SimpleSync(statestore.JsonStateStore(self.state_path), self.state_path + '.journal',
+		                           transport=self.transport)
+		args = self.args(plan_out=None, apply=None)
+		args.__dict__.update(kwargs)
+		return getattr(s, method)(args)
+
+	def sent(self):
+		return len([p for p,b in self.pocket.requests if p.endswith('/send')] +
+		           [p for p,b in self.instapaper.requests if p.endswith('/add')])
+
+	def counts(self):
+		return len(self.pocket.items), sum(len(f) for f in self.instapaper.folders.values())
+
+	def testApply(self):
+		self.run_tool('synchronize', plan_out=self.plan_path)
+		self.assertEquals(self.counts(), (5, 3))
+		self.assertEquals(self.run_tool('apply_plan', apply=self.plan_path), 0)
+		self.assertEquals(self.counts(), (8, 8))
+		sent = self.sent()
+		# the changes were fetched by the plan, so the next run finds nothing
+		self.run_tool('synchronize', dry_run=False)
+		self.assertEquals(self.sent(), sent)
+		self.assertEquals(self.counts(), (8, 8))
+
+	def testApplyTwice(self):
+		self.run_tool('synchronize', plan_out=self.plan_path)
+		self.assertEquals(self.run_tool('apply_plan', apply=self.plan_path), 0)
+		sent = self.sent()
+		self.assertEquals(self.run_tool('apply_plan', apply=self.plan_path), 1)
+		self.assertEquals(self.sent(), sent)
+
+	def testStalePlan(self):
+		self.run_tool('synchronize', plan_out=self.plan_path)
+		self.run_tool('synchronize', dry_run=False)
+		self.assertEquals(self.counts(), (8, 8))
+		sent = self.sent()
+		self.assertEquals(self.run_tool('apply_plan', apply=self.plan_path), 1)
+		self.assertEquals(self.sent(), sent)
+
+	def testReauthenticate(self):
+		self.run_tool('synchronize', plan_out=self.plan_path)
+		# the cached authentication check is wrong
+		self.pocket.errors.append(401)
+		self.assertEquals(self.run_tool('apply_plan', apply=self.plan_path), 0)
+		self.assertTrue('Credentials rejected' in sys.stdout.getvalue())
+		self.assertEquals(self.counts(), (8, 8))
@@ -0,0 +1,46 @@
+from syncitlater import urls
+import unittest
+
+class CanonicalUrlTest(unittest.TestCase):
+	def testHostAndScheme(self):
+		self.assertEquals(urls.canonical_url('HTTP://Example.COM'), 'http://example.com/')
+		self.assertEquals(urls.canonical_url('https://example.com:443/a/B'), 'https://example.com/a/B')
+		self.assertEquals(urls.canonical_url('http://example.com:8080/'), 'http://example.com:8080/')
+
+	def testTrackingParams(self):
+		self.assertEquals(urls.canonical_url('http://example.com/a?utm_source=x&id=1&UTM_medium=y&fbclid=z'),
+		                  'http://example.com/a?id=1')
+		self.assertEquals(urls.canonical_url('http://example.com/a?utm_source=x'), 'http://example.com/a')
+
+	def testFragment(self):
+		self.assertEquals(urls.canonical_url('http://example.com/a#section'), 'http://example.com/a')
+		self.assertEquals(urls.canonical_url('http://example.com/#!/page'), 'http://example.com/#!/page')
+
+	def testOtherUrls(self):
+		self.assertEquals(urls.canonical_url('mailto:Someone@Example.com'), 'mailto:Someone@Example.com')
+		self.assertEquals(urls.canonical_url('http://example.com:bad/'), 'http://example.com:bad/')
+
+class UrlIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.state = {}
+		self.index = urls.UrlIndex(self.state)
+
+	def testAliases(self):
+		self.assertEquals(self.index.aliases('http://a.example.com/'), [])
+		self.index.add_alias('http://a.example.com/', 'http://b.example.com/')
+		self.index.add_alias('http://B.example.com/?utm_source=x', 'http://c.example.com/')
+		for u in ['http://a.example.com/', 'http://b.example.com/', 'http://c.example.com/#top']:
+			self.assertEquals(self.index.key(u), 'http://c.example.com/')
+		self.assertEquals(sorted(self.index.aliases('http://c.example.com/')),
+		                  ['http://a.example.com/', 'http://b.example.com/'])
+		self.assertEquals(sorted(self.index.aliases('http://a.example.com/')),
+		                  ['http://b.example.com/', 'http://c.example.com/'])
+		# same index, rebuilt from the state
+		self.assertEquals(sorted(urls.UrlIndex(self.state).aliases('http://a.example.com/')),
+		                  ['http://b.example.com/', 'http://c.example.com/'])
+
+	def testNoCycles(self):
+		self.index.add_alias('http://a.example.com/', 'http://b.example.com/')
+		self.index.add_alias('http://b.example.com/', 'http://a.example.com/')
+		self.assertEquals(self.state['url_aliases'], {'http://a.example.com/': 'http://b.example.com/'})
+		self.assertEquals(self.index.key('http://a.example.com/'), 'http://b.example.com/')
@@ -0,0 +1,483 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""HTTP transport shared by the API classes"""
+import sys
+import httplib, urlparse
+import socket, ssl, select
+import threading, time
+import random
+import zlib
+import email.utils
+from stats import SyncObserver
+
+import logging
+logger = logging.getLogger(__name__)
+info = logger.info
+dbg = logger.debug
+
+
+class PleaseReauthenticate(Exception):
+    """The credentials were rejected by the service"""
+    pass
+
+
+class ConnectError(socket.error):
+    """The connection to the server failed, so the request was never sent"""
+    pass
+
+
+class HttpError(Exception):
+    """Unexpected HTTP response status"""
+    def __init__(self, url, status, reason, headers, body):
+        Exception.__init__(self, 'HTTP error %d (%s) on %s' % (status, reason, url))
+        self.url = url
+        self.code = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class HttpResponse(object):
+    def __init__(self, url, status, reason, headers, body, stream=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.stream = stream
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpError(self.url, self.status, self.reason, self.headers, self.body)
+
+
+def decode_body(headers, body):
+    """Decode the body of a response according to its Content-Encoding"""
+    encoding = headers.get('content-encoding', '').lower()
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return zlib.decompress(body)
+    return body
+
+
+# statuses meaning that the request was not processed, and can be retried
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+# methods that can be sent again when we don't know if the server got them
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+def _header_delay(value, now):
+    """Parse a delay in seconds, or a HTTP date"""
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        d = email.utils.parsedate_tz(value)
+        if d is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(d) - now)
+
+def retry_after(headers, now=None):
+    """Return the time (in seconds) a response asks us to wait, or None
+
+    Looks at the Retry-After header, and at the rate limit headers
+    (Pocket's X-Limit-User-* and X-Limit-Key-*, and the common
+    X-RateLimit-*) when they say there are no requests left.
+    """
+    if now is None:
+        now = time.time()
+    if headers.has_key('retry-after'):
+        return _header_delay(headers['retry-after'], now)
+    delays = []
+    for prefix in ('x-limit-user-', 'x-limit-key-', 'x-ratelimit-'):
+        remaining = headers.get(prefix + 'remaining')
+        reset = headers.get(prefix + 'reset')
+        if remaining is None or reset is None:
+            continue
+        try:
+            if int(remaining) > 0:
+                continue
+            reset = float(reset)
+        except ValueError:
+            continue
+        if reset > 1000000000:
+            # an absolute timestamp, not a delay
+            reset -= now
+        delays.append(max(0.0, reset))
+    return delays and max(delays) or None
+
+
+class RetryPolicy(object):
+    """Backoff and retry policy for HTTP requests
+
+    Failed requests (connection errors, and responses with a status in
+    RETRY_STATUS) are retried up to max_retries times, after an
+    exponential backoff with jitter. If the server says how long we
+    should wait (see retry_after()), all requests to that host wait that
+    long, even the ones that didn't fail.
+
+    Retries also spend a per-host budget: each retry takes one token,
+    and each successful request gives back budget_ratio tokens (up to
+    budget). When the budget is empty errors are returned immediately, so
+    a service that is down doesn't get even more requests.
+    """
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=60, budget=10, budget_ratio=0.1):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self._hosts = {} # host -> [time when requests are allowed again, budget tokens]
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        h = self._hosts.get(host)
+        if h is None:
+            h = self._hosts[host] = [0.0, float(self.budget)]
+        return h
+
+    def hold(self, host, delay):
+        """Hold all requests to host for delay seconds"""
+        with self._lock:
+            h = self._host(host)
+            h[0] = max(h[0], time.time() + delay)
+
+    def wait(self, host):
+        """Wait until requests to host are allowed"""
+        with self._lock:
+            until = self._host(host)[0]
+        delay = until - time.time()
+        if delay > 0:
+            dbg('waiting %.1f seconds before the next request to %s', delay, host)
+            time.sleep(delay)
+
+    def response(self, host, status, headers):
+        """Update the state of a host after getting a response"""
+        if status < 400:
+            delay = retry_after(headers)
+            if delay and delay <= self.max_delay:
+                # no requests left. Don't make requests that would fail
+                self.hold(host, delay)
+            with self._lock:
+                h = self._host(host)
+                h[1] = min(self.budget, h[1] + self.budget_ratio)
+
+    def retry_delay(self, host, attempt, headers=None):
+        """Return how long to wait before retrying a failed request
+
+        Returns None if the request shouldn't be retried.
+        """
+        if attempt >= self.max_retries:
+            return None
+        asked = headers and retry_after(headers)
+        if asked and asked > self.max_delay:
+            return None
+        with self._lock:
+            h = self._host(host)
+            if h[1] < 1:
+                return None
+            h[1] -= 1
+        if asked:
+            delay = asked + random.uniform(0, self.base_delay)
+            self.hold(host, delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return delay
+
+
+def _is_dropped(conn):
+    """Check if the server closed an idle connection
+
+    Nothing arrives on an idle connection, unless the server closes it.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error):
+        return True
+    return bool(readable)
+
+
+class ResponseStream(object):
+    """File-like object to read (and decode) a response body incrementally
+
+    The connection is given back to the transport when the whole body is
+    read. If the stream is closed before that, the connection is closed.
+    """
+    def __init__(self, transport, key, conn, resp, done=None):
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._done = done
+        self.bytes_read = 0
+        encoding = resp.getheader('content-encoding', '').lower()
+        if encoding == 'gzip':
+            self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._z = zlib.decompressobj()
+        else:
+            self._z = None
+
+    def read(self, size=65536):
+        while self._conn is not None:
+            data = self._resp.read(size)
+            self.bytes_read += len(data)
+            if not data:
+                self._finish()
+                return self._z and self._z.flush() or ''
+            if self._z:
+                data = self._z.decompress(data)
+            if data:
+                return data
+        return ''
+
+    def _finish(self):
+        if self._resp.will_close:
+            self._conn.close()
+        else:
+            self._transport._release(self._key, self._conn)
+        self._conn = None
+        if self._done:
+            self._done(self.bytes_read)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            if self._done:
+                self._done(self.bytes_read)
+
+
+class HttpTransport(object):
+    """HTTP transport that keeps persistent connections
+
+    Idle connections are kept in a pool (per scheme, host and port) and
+    reused by the next requests, so TCP and TLS handshakes are done only
+    once per connection instead of once per request. All HTTPS connections
+    share the same SSL context. The transport may be shared by multiple
+    API objects and threads.
+
+    Failed requests are retried according to the 'retry' attribute (a
+    RetryPolicy object). Requests that may have reached the server are
+    retried only if they are idempotent, and SSL errors are never retried.
+    """
+    def __init__(self, timeout=60, max_idle=8, ssl_context=None, observer=None,
+                 limiter=None, host_limiters=None, retry=None):
+        """Constructor
+
+        observer is a stats.SyncObserver object, that gets an api_call()
+        event for each request.
+
+        limiter is a rate limiter (an object with an acquire() method,
+        like dispatch.RateLimiter) applied to all requests, and
+        host_limiters is a dictionary of rate limiters for the requests
+        to specific hosts. Both are optional.
+
+        retry is the RetryPolicy object used for all requests.
+        """
+        self.timeout = timeout
+        self.observer = observer or SyncObserver()
+        self.limiter = limiter
+        self.host_limiters = host_limiters or {}
+        self.retry = retry or RetryPolicy()
+        self.max_idle = max_idle
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        dbg('opening new %s connection to %s:%s', scheme, host, port)
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+        else:
+            return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        """Get a connection from the pool
+
+        Returns a (connection, reused) tuple.
+        """
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                if not conns:
+                    break
+                conn = conns.pop()
+            if not _is_dropped(conn):
+                return conn, True
+            dbg('idle connection was closed by the server')
+            conn.close()
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for c in conns:
+                c.close()
+
+    def _open(self, conn):
+        """Connect a new connection
+
+        Errors are raised as ConnectError, except SSL errors.
+        """
+        try:
+            conn.connect()
+        except ssl.SSLError:
+            raise
+        except socket.error, e:
+            raise ConnectError(*e.args), None, sys.exc_info()[2]
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def request(self, method, url, body=None, headers=None, stream=False, idempotent=None):
+        """Make a HTTP request
+
+        Returns a HttpResponse object, with the body already decoded.
+        Responses with error status are returned too (after the retries
+        allowed by the retry policy), it's up to the caller to check them.
+
+        Responses with a status in RETRY_STATUS and connection failures
+        are retried for all requests. Other errors (e.g. the connection
+        dropping while we wait for the response) are retried only if
+        idempotent is True, as the server may have processed the request
+        already. By default, idempotent is True for the IDEMPOTENT_METHODS.
+
+        If stream is True, the body of successful responses is not read:
+        the 'stream' attribute of the response is a file-like object
+        that must be read until the end (or closed) by the caller.
+        """
+        u = urlparse.urlsplit(url)
+        scheme = u.scheme.lower()
+        port = u.port or (scheme == 'https' and 443 or 80)
+        key = (scheme, u.hostname, port)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+
+        h = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        if headers:
+            h.update(headers)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            self.retry.wait(key[1])
+            if self.limiter is not None:
+                self.limiter.acquire()
+            limiter = self.host_limiters.get(key[1])
+            if limiter is not None:
+                limiter.acquire()
+
+            try:
+                r = self._request(method, url, key, u.path, path, body, h, stream, idempotent)
+            except ssl.SSLError:
+                # certificate and protocol errors won't go away
+                raise
+            except (socket.error, httplib.HTTPException), e:
+                if not idempotent and not isinstance(e, ConnectError):
+                    raise
+                delay = self.retry.retry_delay(key[1], attempt)
+                if delay is None:
+                    raise
+                info('%s %s failed (%s), retrying in %.1f seconds', method, u.path, e, delay)
+            else:
+                self.retry.response(key[1], r.status, r.headers)
+                if r.status not in RETRY_STATUS:
+                    return r
+                delay = self.retry.retry_delay(key[1], attempt, r.headers)
+                if delay is None:
+                    return r
+                info('%s %s returned status %d, retrying in %.1f seconds', method, u.path, r.status, delay)
+            self.observer.count('retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, method, url, key, upath, path, body, h, stream, idempotent):
+        start = time.time()
+        def done(bytes_in):
+            self.observer.api_call(key[1], method, upath, resp.status, time.time() - start,
+                                   len(body or ''), bytes_in)
+
+        conn, reused = self._acquire(key)
+        try:
+            if not reused:
+                self._open(conn)
+            try:
+                resp = self._send(conn, method, path, body, h)
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+                if not reused or not idempotent:
+                    raise
+                # the server probably closed the idle connection. try again
+                # using a new one (_acquire() already skipped the idle
+                # connections we know were closed, so other requests aren't
+                # sent twice)
+                dbg('reused connection failed, reconnecting')
+                conn.close()
+                conn = self._connect(key)
+                self._open(conn)
+                resp = self._send(conn, method, path, body, h)
+            if stream and resp.status < 400:
+                return HttpResponse(url, resp.status, resp.reason, dict(resp.getheaders()), None,
+                                    ResponseStream(self, key, conn, resp, done))
+            data = resp.read()
+        except:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        done(len(data))
+
+        rheaders = dict(resp.getheaders())
+        return HttpResponse(url, resp.status, resp.reason, rheaders, decode_body(rheaders, data))
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+def default_transport():
+    """Return the HttpTransport shared by all API objects by default"""
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport()
+        return _default_transport
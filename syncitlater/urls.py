@@ -0,0 +1,135 @@
+# Sync It Later
+# Copyright (c) 2012 Eduardo Habkost <ehabkost@raisama.net>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""URL canonicalization, and the index of URL aliases
+
+The same article may be reported with slightly different URLs by each
+service (e.g. Pocket reports the URL after redirects, Instapaper the URL
+that was added). canonical_url() removes the differences that never
+matter, and UrlIndex maps the known aliases of a URL to a single key.
+"""
+import urlparse
+import threading
+
+# query parameters used only for tracking, removed by canonical_url()
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid',
+                             'mc_cid', 'mc_eid', '_hsenc', '_hsmi', 'ref_src'])
+TRACKING_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def _is_tracking_param(p):
+    name = p.split('=', 1)[0].lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+# canonical_url() results, cleared when it reaches CACHE_SIZE entries
+_cache = {}
+CACHE_SIZE = 200000
+
+def canonical_url(url):
+    """Return the canonical form of a URL
+
+    The scheme and host name are made lowercase, the default port and
+    the fragment (unless it's a '#!' one) are removed, an empty path
+    becomes '/', and tracking parameters are removed from the query
+    string. URLs that are not http or https are returned unchanged.
+
+    The same URL is looked up many times during a synchronization, so
+    the results are cached.
+    """
+    r = _cache.get(url)
+    if r is None:
+        r = _canonical_url(url)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[url] = r
+    return r
+
+def _canonical_url(url):
+    try:
+        u = urlparse.urlsplit(url.strip())
+        port = u.port
+    except ValueError:
+        return url
+    scheme = u.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not u.hostname:
+        return url
+
+    netloc = u.hostname.rstrip('.')
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc += ':%d' % (port)
+    if '@' in u.netloc:
+        netloc = u.netloc.rsplit('@', 1)[0] + '@' + netloc
+    query = '&'.join([p for p in u.query.split('&') if p and not _is_tracking_param(p)])
+    fragment = ''
+    if u.fragment.startswith('!'):
+        fragment = u.fragment
+    return urlparse.urlunsplit((scheme, netloc, u.path or '/', query, fragment))
+
+
+class UrlIndex(object):
+    """Maps all known aliases of a URL to a single key
+
+    Keys are canonical URLs. The alias table is kept on the
+    'url_aliases' field of the state dictionary, mapping the canonical
+    form of each alias to the canonical URL it leads to (following
+    redirects, for example). The index may be shared by multiple threads.
+    """
+    def __init__(self, state=None):
+        if state is None:
+            state = {}
+        self.state = state
+        self._reverse = None # key -> list of aliases
+        self._lock = threading.Lock()
+
+    def key(self, url):
+        """Return the key for a URL"""
+        k = canonical_url(url)
+        aliases = self.state.get('url_aliases')
+        if aliases:
+            seen = set()
+            while aliases.has_key(k) and k not in seen:
+                seen.add(k)
+                k = aliases[k]
+        return k
+
+    def add_alias(self, alias, url):
+        """Record that alias is another URL for the same item as url"""
+        with self._lock:
+            a = self.key(alias)
+            k = self.key(url)
+            if a == k:
+                return
+            self.state.setdefault('url_aliases', {})[a] = k
+            if self._reverse is not None:
+                moved = self._reverse.pop(a, [])
+                self._reverse.setdefault(k, []).extend(moved + [a])
+
+    def aliases(self, url):
+        """Return the other known URLs (in canonical form) for the same item as url"""
+        k = self.key(url)
+        with self._lock:
+            if self._reverse is None:
+                self._reverse = {}
+                for a in self.state.get('url_aliases', {}):
+                    self._reverse.setdefault(self.key(a), []).append(a)
+            r = [k] + self._reverse.get(k, [])
+        c = canonical_url(url)
+        return [a for a in r if a != c]